@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""backfills.py
+
+One-off backfills and migrations over whole kinds, run on the task queue
+a page at a time.
+
+Each task processes BACKFILL_BATCH_SIZE entities and enqueues the task
+for the next page with its cursor, so a request stays far from the task
+deadline however large the kind is, and a retry redoes a single page.
+Every batch function is idempotent, so a page processed twice is harmless.
+
+"""
+
+import time
+
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+
+from conference import ConferenceApi
+from models import Conference
+from models import Profile
+from models import Registration
+from models import Session
+from models import Speaker
+
+BACKFILL_BATCH_SIZE = 500
+
+
+def _put(entities):
+    """Re-put entities, storing derived fields and key lists afresh."""
+    ndb.put_multi(entities)
+
+
+def _speakerCounts(speakers):
+    """Recompute Speaker.sessionCount from the sessions listing each
+    speaker, whether or not key_lists has run yet; the counts of a page
+    run concurrently."""
+    futures = [ConferenceApi._countSpeakerSessionsAsync(spk.key)
+               for spk in speakers]
+    for spk, future in zip(speakers, futures):
+        spk.sessionCount = future.get_result()
+    ndb.put_multi(speakers)
+
+
+def _registrations(profiles):
+    """Write a Registration for every conference in conferenceKeysToAttend."""
+    ndb.put_multi([
+        Registration(key=ndb.Key(Registration, wsck, parent=prof.key),
+                     conference=ndb.Key(urlsafe=wsck))
+        for prof in profiles for wsck in prof.conferenceKeysToAttend])
+
+
+# name -> stages of (model, batch function), walked in order
+BACKFILLS = {
+    # Speaker.sessionCount for speakers created before the counter
+    'speaker_counts': [(Speaker, _speakerCounts)],
+    # Conference.occupancy for conferences written before the field
+    'conference_occupancy': [(Conference, _put)],
+    # Session.speakers and Profile.wishlist still holding websafe strings
+    'key_lists': [(Session, _put), (Profile, _put)],
+    # Registrations for registrations made before the roster existed
+    'registrations': [(Profile, _registrations)],
+}
+
+
+def _enqueue(name, run, stage, page, cursor=None):
+    # named per run and page, so a retried task adds its successor once
+    try:
+        taskqueue.add(url='/tasks/backfill/%s' % name,
+                      name='backfill-%s-%s-%d-%d' % (name, run, stage, page),
+                      params={'run': run, 'stage': stage, 'page': page,
+                              'cursor': cursor or ''})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def startBackfill(name):
+    """Enqueue the first page of the named backfill."""
+    _enqueue(name, '%d' % (time.time() * 1000), 0, 0)
+
+
+def runBackfill(name, run, stage, page, cursor=None):
+    """Process one page of a backfill and enqueue the next one."""
+    stages = BACKFILLS[name]
+    model, batch = stages[stage]
+    entities, next_cursor, more = model.query().fetch_page(
+        BACKFILL_BATCH_SIZE,
+        start_cursor=Cursor(urlsafe=cursor) if cursor else None)
+    batch(entities)
+    if more:
+        _enqueue(name, run, stage, page + 1, next_cursor.urlsafe())
+    elif stage + 1 < len(stages):
+        _enqueue(name, run, stage + 1, 0)
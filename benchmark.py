@@ -0,0 +1,482 @@
+#!/usr/bin/env python
+
+"""benchmark.py
+
+Benchmarks for the conference app, run against the App Engine testbed
+datastore and memcache stubs (needs the App Engine SDK on sys.path).
+
+    python benchmark.py seats [--workers N] [--seats N]
+    python benchmark.py serializers [--entities N]
+    python benchmark.py endpoints [--profiles N] [--conferences N]
+        [--sessions N] [--speakers N] [--iterations N]
+        [--baseline FILE] [--save-baseline]
+
+The endpoints suite seeds the stubs, times every ConferenceApi method
+and counts the API RPCs (datastore, memcache, taskqueue) each call
+makes. Results are compared against a baseline file written by an
+earlier run with --save-baseline.
+
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import random
+import threading
+import time
+
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.ext import ndb
+from google.appengine.ext import testbed
+from protorpc import message_types
+
+from models import Conference
+from models import ConferenceForm
+from models import ConferenceQueryForm
+from models import ConferenceQueryForms
+from models import Profile
+from models import Registration
+from models import ProfileMiniForm
+from models import Session
+from models import SessionForm
+from models import SessionQueryForm
+from models import SessionType
+from models import Speaker
+import seats
+import serializers
+
+BENCH_USER = 'bench@example.com'
+DEFAULT_BASELINE = 'benchmark_baseline.json'
+# a p50 this much slower than the baseline is reported as a regression
+REGRESSION_TOLERANCE = 1.25
+
+
+def _setUp():
+    tb = testbed.Testbed()
+    # the endpoints server parses the minor version out of this
+    tb.setup_env(current_version_id='benchmark.1', overwrite=True)
+    tb.activate()
+    tb.init_datastore_v3_stub()
+    tb.init_memcache_stub()
+    tb.init_taskqueue_stub()
+    tb.init_user_stub()
+    ndb.get_context().clear_cache()
+    return tb
+
+
+class _RpcCounter(object):
+    """apiproxy pre-call hook counting RPCs per service."""
+
+    def __init__(self):
+        self.counts = collections.Counter()
+
+    def hook(self, service, call, request, response):
+        # apiproxy inspects the hook's arguments, so it has to be a
+        # function or method rather than a callable object
+        self.counts[service] += 1
+
+    def reset(self):
+        self.counts.clear()
+
+
+def _runWorkers(workers, attempts, reserve):
+    """Call reserve() attempts times from each of workers threads.
+
+    Returns (elapsed seconds, successes, failures).
+    """
+    counts = {'ok': 0, 'failed': 0}
+    lock = threading.Lock()
+
+    def work():
+        ndb.get_context().set_cache_policy(False)
+        for _ in range(attempts):
+            try:
+                ok = reserve()
+            except Exception:
+                ok = False
+            with lock:
+                counts['ok' if ok else 'failed'] += 1
+
+    threads = [threading.Thread(target=work) for _ in range(workers)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.time() - start, counts['ok'], counts['failed']
+
+
+def benchSeats(workers, total_seats):
+    """Compare single-entity vs sharded seat reservation under contention."""
+    attempts = total_seats // workers + 1
+
+    # baseline: every registrant rewrites the Conference entity
+    tb = _setUp()
+    conf_key = Conference(name='bench', maxAttendees=total_seats,
+                          seatsAvailable=total_seats).put()
+
+    @ndb.transactional()
+    def reserveSingle():
+        conf = conf_key.get()
+        if conf.seatsAvailable <= 0:
+            return False
+        conf.seatsAvailable -= 1
+        conf.put()
+        return True
+
+    elapsed, ok, failed = _runWorkers(workers, attempts, reserveSingle)
+    left = conf_key.get().seatsAvailable
+    print('single entity: %6.2fs  %5d reserved  %5d failed  %5d left' % (
+        elapsed, ok, failed, left))
+    tb.deactivate()
+
+    # sharded: registrants only contend on the shard they draw
+    tb = _setUp()
+    conf = Conference(name='bench', maxAttendees=total_seats,
+                      seatsAvailable=total_seats)
+    conf.put()
+    seats.initShards(conf.key, total_seats)
+
+    def reserveSharded():
+        try:
+            seats.reserveSeat(conf)
+            return True
+        except seats.NoSeatsAvailable:
+            return False
+
+    elapsed, ok, failed = _runWorkers(workers, attempts, reserveSharded)
+    left = seats.getSeatsAvailable(conf)
+    print('%2d shards:     %6.2fs  %5d reserved  %5d failed  %5d left' % (
+        seats.NUM_SEAT_SHARDS, elapsed, ok, failed, left))
+    assert ok + left == total_seats, 'conference was oversold'
+    tb.deactivate()
+
+
+def _legacyConferenceToForm(conf, displayName):
+    """The reflective copy serializers.conferenceToForm replaced."""
+    cf = ConferenceForm()
+    for field in cf.all_fields():
+        if hasattr(conf, field.name):
+            if field.name.endswith('Date'):
+                setattr(cf, field.name, str(getattr(conf, field.name)))
+            else:
+                setattr(cf, field.name, getattr(conf, field.name))
+        elif field.name == "websafeKey":
+            setattr(cf, field.name, conf.key.urlsafe())
+    if displayName:
+        setattr(cf, 'organizerDisplayName', displayName)
+    cf.check_initialized()
+    return cf
+
+
+def _legacySessionToForm(sess):
+    """The reflective copy serializers.sessionToForm replaced."""
+    sf = SessionForm()
+    for field in sf.all_fields():
+        if hasattr(sess, field.name):
+            if field.name.endswith('date') or field.name.endswith('Time'):
+                setattr(sf, field.name, str(getattr(sess, field.name)))
+            elif field.name == 'speakers':
+                setattr(sf, field.name,
+                        [key.urlsafe() for key in sess.speakers])
+            else:
+                setattr(sf, field.name, getattr(sess, field.name))
+    sf.check_initialized()
+    return sf
+
+
+def _timeit(func, entities, *args):
+    start = time.time()
+    for entity in entities:
+        func(entity, *args)
+    return time.time() - start
+
+
+def benchSerializers(count):
+    """Compare reflective and precompiled entity -> form copies."""
+    tb = _setUp()
+    today = datetime.date.today()
+    confs = [Conference(id=i + 1, name='conf %d' % i, city='London',
+                        topics=['Medical Innovations', 'Web'],
+                        startDate=today, endDate=today, month=today.month,
+                        maxAttendees=100, seatsAvailable=i % 100,
+                        organizerUserId='user@example.com')
+             for i in range(count)]
+    sessions = [Session(id=i + 1, name='session %d' % i, highlights='-',
+                        speakers=[ndb.Key(Speaker, 1), ndb.Key(Speaker, 2)],
+                        duration=60, date=today,
+                        startTime=datetime.time(10, 0),
+                        session_type=SessionType.LECTURE)
+                for i in range(count)]
+
+    for label, legacy, fast, entities, args in [
+            ('Conference', _legacyConferenceToForm,
+             serializers.conferenceToForm, confs, ('Organizer',)),
+            ('Session', _legacySessionToForm,
+             serializers.sessionToForm, sessions, ())]:
+        before = _timeit(legacy, entities, *args)
+        after = _timeit(fast, entities, *args)
+        print('%-10s x%d: reflective %6.3fs  precompiled %6.3fs  (%.1fx)' % (
+            label, count, before, after, before / after))
+    tb.deactivate()
+
+
+def _seed(num_profiles, num_conferences, num_sessions, num_speakers):
+    """Fill the datastore stub; return the keys the endpoints need."""
+    rnd = random.Random(42)
+    today = datetime.date.today()
+    cities = ['London', 'Paris', 'Tokyo', 'Chicago', 'San Francisco']
+    topics = ['Medical Innovations', 'Web', 'Programming Languages']
+
+    emails = [BENCH_USER] + ['user%d@example.com' % i
+                             for i in range(1, num_profiles)]
+    profiles = [Profile(id=email, displayName=email.split('@')[0],
+                        mainEmail=email, teeShirtSize='NOT_SPECIFIED')
+                for email in emails]
+
+    spk_keys = [ndb.Key(Speaker, i + 1) for i in range(num_speakers)]
+    speakers = [Speaker(key=key, firstName='First%d' % i,
+                        lastName='Last%d' % i, institution='Institute',
+                        websafeKey=key.urlsafe())
+                for i, key in enumerate(spk_keys)]
+
+    conferences = []
+    for i in range(num_conferences):
+        max_attendees = rnd.choice([0, 10, 100, 1000])
+        start = today + datetime.timedelta(days=rnd.randint(0, 365))
+        conferences.append(Conference(
+            parent=profiles[i % len(profiles)].key, id=i + 1,
+            name='Conference %d' % i, description='-',
+            organizerUserId=emails[i % len(emails)],
+            topics=rnd.sample(topics, 2), city=rnd.choice(cities),
+            startDate=start, endDate=start, month=start.month,
+            maxAttendees=max_attendees,
+            seatsAvailable=rnd.randint(0, max_attendees)))
+    ndb.put_multi(profiles + conferences)
+    for conf in conferences:
+        seats.initShards(conf.key, conf.seatsAvailable)
+
+    sessions = []
+    types = list(SessionType)
+    for i in range(num_sessions):
+        conf = conferences[i % len(conferences)]
+        key = ndb.Key(Session, i + 1, parent=conf.key)
+        featured = rnd.sample(spk_keys, min(2, len(spk_keys)))
+        for spk_key in featured:
+            speakers[spk_key.id() - 1].sessionCount += 1
+        sessions.append(Session(
+            key=key, name='Session %d' % i, highlights='-',
+            speakers=featured,
+            duration=rnd.choice([30, 60, 90]), date=conf.startDate,
+            startTime=datetime.time(rnd.randint(8, 21), 0),
+            session_type=rnd.choice(types),
+            websafeConferenceKey=conf.key.urlsafe(),
+            websafeSessionKey=key.urlsafe()))
+    ndb.put_multi(speakers + sessions)
+
+    # the bench user attends some conferences and wishlists their sessions
+    bench = profiles[0]
+    attending = conferences[:min(10, len(conferences))]
+    attending_keys = set(c.key for c in attending)
+    bench.conferenceKeysToAttend = [c.key.urlsafe() for c in attending]
+    bench.wishlist = [sess.key for sess in sessions
+                      if sess.key.parent() in attending_keys][:200]
+    bench.put()
+    # and every profile attends the first conference
+    pairs = ([(bench, c) for c in attending] +
+             [(prof, conferences[0]) for prof in profiles])
+    registrations = dict(
+        (ndb.Key(Registration, conf.key.urlsafe(), parent=prof.key), conf.key)
+        for prof, conf in pairs)
+    ndb.put_multi([Registration(key=reg_key, conference=conf_key)
+                   for reg_key, conf_key in registrations.items()])
+
+    return {
+        'conference': conferences[0].key.urlsafe(),
+        # one with seats the bench user is not registered for yet
+        'open_conference': next(
+            (c.key.urlsafe() for c in conferences
+             if c.seatsAvailable > 0 and c.key not in attending_keys),
+            conferences[-1].key.urlsafe()),
+        'session': sessions[0].key.urlsafe() if sessions else None,
+        'speaker': spk_keys[0].urlsafe() if spk_keys else None,
+    }
+
+
+def _endpointCalls(keys):
+    """Return [(name, callable)] exercising every read/write endpoint."""
+    from conference import ConferenceApi
+    from conference import CONF_AND_TYPE_REQUEST
+    from conference import CONF_GET_REQUEST
+    from conference import CONF_PAGE_REQUEST
+    from conference import OCCUPANCY_REQUEST
+    from conference import PAGE_REQUEST
+    from conference import SPK_GET_REQUEST
+    from conference import SPK_SESS_REQUEST
+
+    api = ConferenceApi()
+    void = message_types.VoidMessage
+    conf_req = CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=keys['conference'])
+    open_req = CONF_GET_REQUEST.combined_message_class(
+        websafeConferenceKey=keys['open_conference'])
+    query = ConferenceQueryForms(filters=[ConferenceQueryForm(
+        field='CITY', operator='EQ', value='London')])
+
+    def register():
+        api.registerForConference(open_req)
+        api.unregisterFromConference(open_req)
+
+    def speakerSwap():
+        req = SPK_SESS_REQUEST.combined_message_class(
+            websafeSessionKey=keys['session'],
+            websafeSpeakerKey=keys['speaker'])
+        try:
+            api.removeSpeakerFromSession(req)
+        except Exception:
+            pass
+        api.addSpeakerToSession(req)
+
+    return [
+        ('getProfile', lambda: api.getProfile(void())),
+        ('saveProfile', lambda: api.saveProfile(
+            ProfileMiniForm(displayName='bench'))),
+        ('getConference', lambda: api.getConference(conf_req)),
+        ('getConferencesCreated', lambda: api.getConferencesCreated(void())),
+        ('queryConferences', lambda: api.queryConferences(query)),
+        ('getConferencesToAttend', lambda: api.getConferencesToAttend(void())),
+        ('registration', register),
+        ('getAnnouncement', lambda: api.getAnnouncement(void())),
+        ('getConferenceSessions', lambda: api.getConferenceSessions(conf_req)),
+        ('getConferenceSessionsByType', lambda: api.getConferenceSessionsByType(
+            CONF_AND_TYPE_REQUEST.combined_message_class(
+                websafeConferenceKey=keys['conference'],
+                session_type=SessionType.LECTURE))),
+        ('getConferenceSessionsBySpeaker',
+         lambda: api.getConferenceSessionsBySpeaker(
+             SPK_GET_REQUEST.combined_message_class(
+                 websafeSpeakerKey=keys['speaker']))),
+        ('earlynonworkshop', lambda: api.earlynonworkshop(conf_req)),
+        ('searchSessions', lambda: api.searchSessions(SessionQueryForm(
+            websafeConferenceKey=keys['conference'],
+            sessionTypes=[SessionType.LECTURE, SessionType.KEYNOTE],
+            startAfter='09:00', startBefore='17:00',
+            minDuration=30, maxDuration=90))),
+        ('listSpeakers', lambda: api.listSpeakers(void())),
+        ('speakerToSession', speakerSwap),
+        ('createSession', lambda: api.createSession(SessionForm(
+            name='bench', websafeConferenceKey=keys['conference'],
+            speakers=[keys['speaker']], startTime='10:00'))),
+        ('getSessionsInWishlist', lambda: api.getSessionsInWishlist(void())),
+        ('listSpeakersInWishlist', lambda: api.listSpeakersInWishlist(void())),
+        ('popularSpeakers', lambda: api.popularSpeakers(
+            PAGE_REQUEST.combined_message_class())),
+        ('successfulConferences', lambda: api.successfulConferences(
+            OCCUPANCY_REQUEST.combined_message_class())),
+        ('getConferenceFeaturedSpeaker',
+         lambda: api.getConferenceFeaturedSpeaker(conf_req)),
+        ('getConferenceAttendees', lambda: api.getConferenceAttendees(
+            CONF_PAGE_REQUEST.combined_message_class(
+                websafeConferenceKey=keys['conference']))),
+    ]
+
+
+def _percentile(samples, pct):
+    ordered = sorted(samples)
+    index = int(round(pct / 100.0 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def benchEndpoints(num_profiles, num_conferences, num_sessions, num_speakers,
+                   iterations, baseline_path, save_baseline):
+    """Time every ConferenceApi method and compare against a baseline."""
+    tb = _setUp()
+    os.environ['ENDPOINTS_AUTH_EMAIL'] = BENCH_USER
+    os.environ['ENDPOINTS_AUTH_DOMAIN'] = 'example.com'
+    keys = _seed(num_profiles, num_conferences, num_sessions, num_speakers)
+
+    counter = _RpcCounter()
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'benchmark_rpc_counter', counter.hook)
+
+    results = {}
+    for name, call in _endpointCalls(keys):
+        samples = []
+        counter.reset()
+        for i in range(iterations):
+            # every endpoint call starts with a fresh ndb in-context cache
+            # and request context, as a new request would; memcache stays
+            # warm
+            os.environ['REQUEST_LOG_ID'] = '%s-%d' % (name, i)
+            ndb.get_context().clear_cache()
+            start = time.time()
+            call()
+            samples.append((time.time() - start) * 1000)
+        results[name] = {
+            'p50': _percentile(samples, 50),
+            'p95': _percentile(samples, 95),
+            'p99': _percentile(samples, 99),
+            'rpcs': dict((service, float(count) / iterations)
+                         for service, count in counter.counts.items()),
+        }
+
+    baseline = {}
+    if baseline_path and os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+
+    print('%-32s %9s %9s %9s %7s  %s' % (
+        'endpoint', 'p50 ms', 'p95 ms', 'p99 ms', 'RPCs', 'vs baseline'))
+    regressions = []
+    for name, _ in _endpointCalls(keys):
+        res = results[name]
+        note = ''
+        if name in baseline:
+            ratio = res['p50'] / max(baseline[name]['p50'], 0.001)
+            note = '%.2fx  RPCs %.1f -> %.1f' % (
+                ratio, sum(baseline[name]['rpcs'].values()),
+                sum(res['rpcs'].values()))
+            if ratio > REGRESSION_TOLERANCE:
+                note += '  REGRESSION'
+                regressions.append(name)
+        print('%-32s %9.2f %9.2f %9.2f %7.1f  %s' % (
+            name, res['p50'], res['p95'], res['p99'],
+            sum(res['rpcs'].values()), note))
+
+    if save_baseline and baseline_path:
+        with open(baseline_path, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print('baseline written to %s' % baseline_path)
+
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Clear()
+    tb.deactivate()
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('suite', choices=['seats', 'serializers', 'endpoints'])
+    parser.add_argument('--workers', type=int, default=20)
+    parser.add_argument('--seats', type=int, default=1000)
+    parser.add_argument('--entities', type=int, default=10000)
+    parser.add_argument('--profiles', type=int, default=100)
+    parser.add_argument('--conferences', type=int, default=500)
+    parser.add_argument('--sessions', type=int, default=2000)
+    parser.add_argument('--speakers', type=int, default=300)
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true')
+    args = parser.parse_args()
+
+    if args.suite == 'seats':
+        benchSeats(args.workers, args.seats)
+    elif args.suite == 'serializers':
+        benchSerializers(args.entities)
+    elif args.suite == 'endpoints':
+        regressions = benchEndpoints(
+            args.profiles, args.conferences, args.sessions, args.speakers,
+            args.iterations, args.baseline, args.save_baseline)
+        if regressions:
+            raise SystemExit('regressions: %s' % ', '.join(regressions))
@@ -13,21 +13,32 @@ created by wesc on 2014 apr 21
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
 
+import collections
+import os
+import time
 from datetime import datetime
 
 import endpoints
 from protorpc import messages
 from protorpc import message_types
+from protorpc import protojson
 from protorpc import remote
 
+from google.appengine.api import datastore_errors
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
 from google.appengine.ext import ndb
+from google.appengine.datastore.datastore_query import Cursor
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 
+from models import AnnouncementSnapshot
+from models import AttendeeForm
+from models import AttendeeForms
 from models import ConflictException
 from models import Profile
 from models import ProfileMiniForm
 from models import ProfileForm
+from models import Registration
 from models import StringMessage
 from models import BooleanMessage
 from models import Conference
@@ -35,24 +46,54 @@ from models import ConferenceForm
 from models import ConferenceForms
 from models import ConferenceQueryForm
 from models import ConferenceQueryForms
-from models import TeeShirtSize
 from models import Session
 from models import SessionForm
 from models import SessionForms
+from models import SessionQueryForm
 from models import SessionType
 from models import Speaker
 from models import SpeakerForm
 from models import SpeakerForms
+from models import SpeakerSessionForms
 
 from settings import WEB_CLIENT_ID, ANDROID_AUDIENCE, API_EXPLORER_CLIENT_ID, ANDROID_CLIENT_ID, IOS_CLIENT_ID
 
-from utils import getUserId
+from utils import RequestContext
+
+import planner
+import seats
+import serializers
 
 EMAIL_SCOPE = endpoints.EMAIL_SCOPE
 API_EXPLORER_CLIENT_ID = endpoints.API_EXPLORER_CLIENT_ID
+SEAT_SYNC_INTERVAL = 10
+# lets the indexes of bulk-created sessions catch up before the speaker
+# recount queries them
+SPEAKER_RECOUNT_DELAY = 5
 MEMCACHE_ANNOUNCEMENTS_KEY = "RECENT_ANNOUNCEMENTS"
+MEMCACHE_FEATURED_SPEAKERS_KEY = "FEATURED SPEAKERS"
+MEMCACHE_FEATURED_SPEAKERS_TPL = "FEATURED_SPEAKERS_%s"
+MEMCACHE_CONFERENCE_TPL = "CONFERENCE_%s"
+MEMCACHE_CONFERENCE_VERSION_TPL = "CONFERENCE_VERSION_%s"
+MEMCACHE_ORGANIZER_NAME_PREFIX = "ORGANIZER_NAME_"
+MEMCACHE_ATTENDING_TPL = "ATTENDING_%s"
+# registration drops a user's list; the TTL bounds how stale seat counts
+# and conference edits in it can get
+ATTENDING_CACHE_TTL = 300
+# bounds how long a name cached by a read racing a rename can linger
+ORGANIZER_NAME_TTL = 3600
+# speaker changes drop a conference's entry; the TTL bounds how long a
+# recompute racing one of them can serve stale speakers
+FEATURED_SPEAKERS_TTL = 3600
+FEATURED_SPEAKERS_LOCK_TTL = 30
 ANNOUNCEMENT_TPL = ('Last chance to attend! The following conferences '
                     'are nearly sold out: %s')
+ANNOUNCEMENT_SNAPSHOT_ID = 'nearly-sold-out'
+NEARLY_SOLD_OUT_SEATS = 5
+# Conference.seatsAvailable lags the seat shards by up to one seat sync,
+# so registration checks the live count of conferences this close to
+# the threshold; the seat sync catches any it skips
+ANNOUNCEMENT_CHECK_MARGIN = 50
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
 DEFAULTS = {
@@ -71,21 +112,22 @@ DEAFULTS_SESSION = {
 }
 
 
-OPERATORS = {
-    'EQ':   '=',
-            'GT':   '>',
-            'GTEQ': '>=',
-            'LT':   '<',
-            'LTEQ': '<=',
-            'NE':   '!='
-}
-
-FIELDS = {
-    'CITY': 'city',
-            'TOPIC': 'topics',
-            'MONTH': 'month',
-            'MAX_ATTENDEES': 'maxAttendees',
-}
+DEFAULT_PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+# most entities a post-filtered page reads before returning short
+MAX_SCAN_SIZE = 1000
+# speakers of a session are updated in one cross-group transaction,
+# which can span at most 25 entity groups
+MAX_SESSION_SPEAKERS = 20
+MAX_BULK_SESSIONS = 500
+MAX_BULK_SPEAKERS = 500
+MAX_BULK_ASSIGNMENTS = 500
+POPULAR_SPEAKER_SESSIONS = 2
+SUCCESSFUL_OCCUPANCY = 0.95
+# datastore runs IN filters as one subquery per value (per combination
+# of values when several are IN filters) and caps them at 30
+MAX_QUERY_SUBQUERIES = 30
+EARLY_SESSION_END = "19:00"
 
 CONF_GET_REQUEST = endpoints.ResourceContainer(
     message_types.VoidMessage,
@@ -117,6 +159,26 @@ SESS_REQUEST = endpoints.ResourceContainer(
     websafeSessionKey=messages.StringField(1, required=True),
 )
 
+PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2),
+)
+
+CONF_PAGE_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    websafeConferenceKey=messages.StringField(1, required=True),
+    pageSize=messages.IntegerField(2, variant=messages.Variant.INT32),
+    cursor=messages.StringField(3),
+)
+
+OCCUPANCY_REQUEST = endpoints.ResourceContainer(
+    message_types.VoidMessage,
+    pageSize=messages.IntegerField(1, variant=messages.Variant.INT32),
+    cursor=messages.StringField(2),
+    minOccupancy=messages.FloatField(3),
+)
+
 
 # - - - - - - - - - - - - - - - - - - - - - - - - - - - - - -
 
@@ -128,33 +190,24 @@ SESS_REQUEST = endpoints.ResourceContainer(
 class ConferenceApi(remote.Service):
     """Conference API v0.1"""
 
+    @property
+    def _ctx(self):
+        """Request-scoped user context, built lazily once per RPC."""
+        request_id = os.environ.get('REQUEST_LOG_ID')
+        ctx = getattr(self, '_request_context', None)
+        if ctx is None or ctx.requestId != request_id:
+            ctx = self._request_context = RequestContext(request_id)
+        return ctx
+
 # - - - Conference objects - - - - - - - - - - - - - - - - -
 
     def _copyConferenceToForm(self, conf, displayName):
         """Copy relevant fields from Conference to ConferenceForm."""
-        cf = ConferenceForm()
-        for field in cf.all_fields():
-            if hasattr(conf, field.name):
-                # convert Date to date string; just copy others
-                if field.name.endswith('Date'):
-                    setattr(cf, field.name, str(getattr(conf, field.name)))
-                else:
-                    setattr(cf, field.name, getattr(conf, field.name))
-            elif field.name == "websafeKey":
-                setattr(cf, field.name, conf.key.urlsafe())
-        if displayName:
-            setattr(cf, 'organizerDisplayName', displayName)
-        cf.check_initialized()
-        return cf
-
-    def _createConferenceObject(self, request):
-        """Create or update Conference object, returning ConferenceForm/request."""
-        # preload necessary data items
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        return serializers.conferenceToForm(conf, displayName)
 
+    @staticmethod
+    def _conferenceDataFromForm(request):
+        """Validate a ConferenceForm and return the data for a new Conference."""
         if not request.name:
             raise endpoints.BadRequestException(
                 "Conference 'name' field required")
@@ -187,6 +240,15 @@ class ConferenceApi(remote.Service):
         # set seatsAvailable to be same as maxAttendees on creation
         if data["maxAttendees"] > 0:
             data["seatsAvailable"] = data["maxAttendees"]
+        return data
+
+    def _createConferenceObject(self, request):
+        """Create or update Conference object, returning ConferenceForm/request."""
+        # preload necessary data items
+        user = self._ctx.requireUser()
+        user_id = self._ctx.userId
+        data = self._conferenceDataFromForm(request)
+
         # generate Profile Key based on user ID and Conference
         # ID based on Profile key get Conference key from ID
         p_key = ndb.Key(Profile, user_id)
@@ -198,6 +260,7 @@ class ConferenceApi(remote.Service):
         # create Conference, send email to organizer confirming
         # creation of Conference & return (modified) ConferenceForm
         Conference(**data).put()
+        seats.initShards(c_key, data['seatsAvailable'])
         taskqueue.add(params={'email': user.email(),
                               'conferenceInfo': repr(request)},
                       url='/tasks/send_confirmation_email'
@@ -206,17 +269,14 @@ class ConferenceApi(remote.Service):
 
     @ndb.transactional()
     def _updateConferenceObject(self, request):
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        user_id = self._ctx.userId
 
         # copy ConferenceForm/ProtoRPC Message into dict
         data = {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
 
         # update existing conference
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._keyFromWebsafe(request.websafeConferenceKey, Conference).get()
         # check that conference exists
         if not conf:
             raise endpoints.NotFoundException(
@@ -229,10 +289,12 @@ class ConferenceApi(remote.Service):
 
         # Not getting all the fields, so don't create a new object; just
         # copy relevant fields from ConferenceForm to Conference object
+        old_max = conf.maxAttendees or 0
         for field in request.all_fields():
             data = getattr(request, field.name)
-            # only copy fields where we get data
-            if data not in (None, []):
+            # only copy fields where we get data; seatsAvailable follows
+            # the seat shards, not the form
+            if data not in (None, []) and field.name != 'seatsAvailable':
                 # special handling for dates (convert string to Date)
                 if field.name in ('startDate', 'endDate'):
                     data = datetime.strptime(data, "%Y-%m-%d").date()
@@ -240,9 +302,12 @@ class ConferenceApi(remote.Service):
                         conf.month = data.month
                 # write to Conference object
                 setattr(conf, field.name, data)
+        # a new maxAttendees opens or closes that many seats; the seat
+        # sync corrects the estimate once the shards have been adjusted
+        delta = (conf.maxAttendees or 0) - old_max
+        conf.seatsAvailable = max((conf.seatsAvailable or 0) + delta, 0)
         conf.put()
-        prof = ndb.Key(Profile, user_id).get()
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return conf, delta
 
     @endpoints.method(ConferenceForm, ConferenceForm, path='conference',
                       http_method='POST', name='createConference')
@@ -255,21 +320,100 @@ class ConferenceApi(remote.Service):
                       http_method='PUT', name='updateConference')
     def updateConference(self, request):
         """Update conference w/provided fields & return w/updated info."""
-        return self._updateConferenceObject(request)
+        conf, delta = self._updateConferenceObject(request)
+        # seat shards live in their own entity groups, so they are adjusted
+        # outside of the conference transaction; only the change is applied,
+        # so registrations in flight keep their seats
+        if delta:
+            seats.adjustSeats(conf, delta)
+            self._scheduleSeatSync(conf.key.urlsafe())
+        # invalidate once the transaction has committed, so a concurrent
+        # getConference can't cache the pre-update entity
+        self._invalidateConferenceCache([conf.key])
+        # the Profile is in another entity group, so it is read once the
+        # conference transaction has committed
+        prof = self._ctx.getProfile()
+        conf.seatsAvailable = seats.getSeatsAvailable(conf)
+        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
 
     @endpoints.method(CONF_GET_REQUEST, ConferenceForm,
                       path='conference/{websafeConferenceKey}',
                       http_method='GET', name='getConference')
     def getConference(self, request):
         """Return requested conference (by websafeConferenceKey)."""
+        conf_key = self._keyFromWebsafe(request.websafeConferenceKey, Conference)
+        wsck = conf_key.urlsafe()
+        cache_key = MEMCACHE_CONFERENCE_TPL % wsck
+        version_key = MEMCACHE_CONFERENCE_VERSION_TPL % wsck
+
+        # serve the cached form if nothing invalidated it since it was built
+        cached = memcache.get_multi([cache_key, version_key])
+        version = cached.get(version_key)
+        if version is None:
+            memcache.add(version_key, self._newCacheVersion())
+            version = memcache.get(version_key)
+        if cache_key in cached and version is not None:
+            entry_version, payload = cached[cache_key]
+            if entry_version == version:
+                return protojson.decode_message(ConferenceForm, payload)
+
         # get Conference object from request; bail if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = conf_key.get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
-        prof = conf.key.parent().get()
+        names = self._getOrganizerNames([conf.organizerUserId])
+        # report the live seat count from the shards
+        conf.seatsAvailable = seats.getSeatsAvailable(conf)
+        cf = self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+
+        # stamp the entry with the version read before building it: if an
+        # invalidation raced with us, the stamp is already stale and the
+        # entry will never be served
+        if version is not None:
+            memcache.set(cache_key, (version, protojson.encode_message(cf)))
         # return ConferenceForm
-        return self._copyConferenceToForm(conf, getattr(prof, 'displayName'))
+        return cf
+
+    @staticmethod
+    def _getOrganizerNames(user_ids):
+        """Return {user id: displayName} for the distinct organizers in
+        user_ids, read through a memcache entry per organizer. Organizers
+        without a Profile are left out.
+        """
+        user_ids = list(set(user_id for user_id in user_ids if user_id))
+        if not user_ids:
+            return {}
+        names = memcache.get_multi(
+            user_ids, key_prefix=MEMCACHE_ORGANIZER_NAME_PREFIX)
+        missing = [user_id for user_id in user_ids if user_id not in names]
+        if missing:
+            found = {}
+            profiles = ndb.get_multi([ndb.Key(Profile, user_id) for user_id in missing])
+            for profile in profiles:
+                if profile:
+                    found[profile.key.id()] = profile.displayName
+            memcache.set_multi(found, time=ORGANIZER_NAME_TTL,
+                               key_prefix=MEMCACHE_ORGANIZER_NAME_PREFIX)
+            names.update(found)
+        return names
+
+    @staticmethod
+    def _newCacheVersion():
+        """Return a starting version for a conference cache entry.
+
+        Time based, so a version counter that memcache evicted never
+        restarts at a value an older entry may still be stamped with.
+        """
+        return int(time.time() * 1000)
+
+    @staticmethod
+    def _invalidateConferenceCache(conf_keys):
+        """Bump the cache version of the given conferences."""
+        memcache.offset_multi(
+            dict((MEMCACHE_CONFERENCE_VERSION_TPL % conf_key.urlsafe(), 1)
+                 for conf_key in conf_keys),
+            initial_value=ConferenceApi._newCacheVersion())
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='getConferencesCreated',
@@ -277,94 +421,100 @@ class ConferenceApi(remote.Service):
     def getConferencesCreated(self, request):
         """Return conferences created by user."""
         # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+        prof = self._ctx.getProfile()
 
         # create ancestor query for all key matches for this user
-        confs = Conference.query(ancestor=ndb.Key(Profile, user_id))
-        prof = ndb.Key(Profile, user_id).get()
+        confs = Conference.query(ancestor=prof.key)
         # return set of ConferenceForm objects per Conference
         return ConferenceForms(
             items=[self._copyConferenceToForm(
                 conf, getattr(prof, 'displayName')) for conf in confs]
         )
 
-    def _getQuery(self, request):
-        """Return formatted query from the submitted filters."""
-        q = Conference.query()
-        inequality_filter, filters = self._formatFilters(request.filters)
-
-        # If exists, sort on inequality filter first
-        if not inequality_filter:
-            q = q.order(Conference.name)
+    def _fetchPage(self, query, pageSize=None, cursor=None, residual=None,
+                   keys_only=False):
+        """Run query for a single page, returning (entities, next cursor).
+
+        If residual is given, only entities passing it are returned; the
+        query is streamed until the page is full or MAX_SCAN_SIZE
+        entities were read, so a page may come back short, or even
+        empty with a next cursor that clients should continue from. With
+        keys_only, the query returns keys and entities are batch-loaded
+        with get_multi(), which is served from ndb's cache when it can;
+        entities deleted in between are skipped.
+        """
+        # clamp the page size so no single call reads an unbounded result set
+        page_size = min(pageSize or DEFAULT_PAGE_SIZE, MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise endpoints.BadRequestException(
+                "'pageSize' must be a positive number")
+        try:
+            start_cursor = Cursor(urlsafe=cursor) if cursor else None
+        except datastore_errors.BadValueError:
+            raise endpoints.BadRequestException("Invalid cursor: %s" % cursor)
+
+        if residual is None:
+            results, next_cursor, more = query.fetch_page(
+                page_size, start_cursor=start_cursor, keys_only=keys_only)
+            if keys_only:
+                results = [entity for entity in ndb.get_multi(results) if entity]
         else:
-            q = q.order(ndb.GenericProperty(inequality_filter))
-            q = q.order(Conference.name)
-
-        for filtr in filters:
-            if filtr["field"] in ["month", "maxAttendees"]:
-                filtr["value"] = int(filtr["value"])
-            formatted_query = ndb.query.FilterNode(
-                filtr["field"], filtr["operator"], filtr["value"])
-            q = q.filter(formatted_query)
-        return q
-
-    def _formatFilters(self, filters):
-        """Parse, check validity and format user supplied filters."""
-        formatted_filters = []
-        inequality_field = None
-
-        for f in filters:
-            filtr = {field.name: getattr(f, field.name)
-                     for field in f.all_fields()}
+            results, next_cursor, more = self._scanPage(
+                query, page_size, start_cursor, residual, keys_only)
+        if more and next_cursor:
+            return results, next_cursor.urlsafe()
+        return results, None
 
-            try:
-                filtr["field"] = FIELDS[filtr["field"]]
-                filtr["operator"] = OPERATORS[filtr["operator"]]
-            except KeyError:
-                raise endpoints.BadRequestException(
-                    "Filter contains invalid field or operator.")
-
-            # Every operation except "=" is an inequality
-            if filtr["operator"] != "=":
-                # check if inequality operation has been used in previous filters
-                # disallow the filter if inequality was performed on a different field before
-                # track the field on which the inequality operation is
-                # performed
-                if inequality_field and inequality_field != filtr["field"]:
-                    raise endpoints.BadRequestException(
-                        "Inequality filter is allowed on only one field.")
-                else:
-                    inequality_field = filtr["field"]
-
-            formatted_filters.append(filtr)
-        return (inequality_field, formatted_filters)
+    @staticmethod
+    def _scanPage(query, page_size, start_cursor, residual, keys_only=False):
+        """Stream query from start_cursor, keeping entities that pass
+        residual; returns (entities, cursor, more) like fetch_page()."""
+        results = []
+        scanned = 0
+        it = query.iter(start_cursor=start_cursor, produce_cursors=True,
+                        batch_size=page_size, keys_only=keys_only)
+        while it.has_next():
+            # read a batch, remembering the cursor after each result so
+            # the page can end anywhere inside it
+            batch = []
+            while len(batch) < page_size and it.has_next():
+                batch.append((it.next(), it.cursor_after()))
+            entities = [item for item, _ in batch]
+            if keys_only:
+                entities = ndb.get_multi(entities)
+            for i, entity in enumerate(entities):
+                scanned += 1
+                if entity and residual(entity):
+                    results.append(entity)
+                if len(results) == page_size or scanned == MAX_SCAN_SIZE:
+                    more = i < len(batch) - 1 or it.probably_has_next()
+                    return results, batch[i][1], more
+        return results, None, False
 
     @endpoints.method(ConferenceQueryForms, ConferenceForms,
                       path='queryConferences',
                       http_method='POST',
                       name='queryConferences')
     def queryConferences(self, request):
-        """Query for conferences."""
-        conferences = self._getQuery(request)
-
-        # need to fetch organiser displayName from profiles
-        # get all keys and use get_multi for speed
-        organisers = [(ndb.Key(Profile, conf.organizerUserId))
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
-
-        # return individual ConferenceForm object per Conference
+        """Query for conferences, one page at a time."""
+        query_plan = planner.plan(request.filters)
+        conferences, next_cursor = self._fetchPage(
+            query_plan.query, request.pageSize, request.cursor,
+            query_plan.residual if query_plan.residualFilters else None,
+            keys_only=True)
+
+        # need to fetch organiser displayName from profiles, once per
+        # organiser
+        names = self._getOrganizerNames(
+            conf.organizerUserId for conf in conferences)
+
+        # return individual ConferenceForm object per Conference, along with
+        # the cursor for the next page (if any)
         return ConferenceForms(
-            items=[self._copyConferenceToForm(conf, names[conf.organizerUserId]) for conf in
-                   conferences]
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences],
+            nextCursor=next_cursor,
+            queryPlan=query_plan.explain() if request.explain else None
         )
 
 
@@ -372,41 +522,11 @@ class ConferenceApi(remote.Service):
 
     def _copyProfileToForm(self, prof):
         """Copy relevant fields from Profile to ProfileForm."""
-        # copy relevant fields from Profile to ProfileForm
-        pf = ProfileForm()
-        for field in pf.all_fields():
-            if hasattr(prof, field.name):
-                # convert t-shirt string to Enum; just copy others
-                if field.name == 'teeShirtSize':
-                    setattr(pf, field.name, getattr(
-                        TeeShirtSize, getattr(prof, field.name)))
-                else:
-                    setattr(pf, field.name, getattr(prof, field.name))
-        pf.check_initialized()
-        return pf
+        return serializers.profileToForm(prof)
 
     def _getProfileFromUser(self):
         """Return user Profile from datastore, creating new one if non-existent."""
-        # make sure user is authed
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # get Profile from datastore
-        user_id = getUserId(user)
-        p_key = ndb.Key(Profile, user_id)
-        profile = p_key.get()
-        # create new Profile if not there
-        if not profile:
-            profile = Profile(
-                key=p_key,
-                displayName=user.nickname(),
-                mainEmail=user.email(),
-                teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
-            )
-            profile.put()
-
-        return profile      # return Profile
+        return self._ctx.getProfile()
 
     def _doProfile(self, save_request=None):
         """Get user Profile and return to user, possibly updating it first."""
@@ -415,6 +535,8 @@ class ConferenceApi(remote.Service):
 
         # if saveProfile(), process user-modifyable fields
         if save_request:
+            displayName = prof.displayName
+            changed = False
             for field in ('displayName', 'teeShirtSize'):
                 if hasattr(save_request, field):
                     val = getattr(save_request, field)
@@ -424,7 +546,15 @@ class ConferenceApi(remote.Service):
                         #    setattr(prof, field, str(val).upper())
                         # else:
                         #    setattr(prof, field, val)
-                        prof.put()
+                        changed = True
+            if changed:
+                self._ctx.putProfile(prof)
+
+            # cached conferences show the organizer's displayName
+            if prof.displayName != displayName:
+                memcache.delete(MEMCACHE_ORGANIZER_NAME_PREFIX + prof.key.id())
+                self._invalidateConferenceCache(
+                    Conference.query(ancestor=prof.key).fetch(keys_only=True))
 
         # return ProfileForm
         return self._copyProfileToForm(prof)
@@ -444,63 +574,123 @@ class ConferenceApi(remote.Service):
 
 # - - - Announcements - - - - - - - - - - - - - - - - - - - -
 
+    @staticmethod
+    def _announcementSnapshotKey():
+        return ndb.Key(AnnouncementSnapshot, ANNOUNCEMENT_SNAPSHOT_ID)
+
+    @staticmethod
+    def _formatAnnouncement(snapshot):
+        """Return the announcement text for a snapshot, "" if empty."""
+        names = sorted((snapshot and snapshot.conferences or {}).values())
+        if not names:
+            return ""
+        return ANNOUNCEMENT_TPL % ', '.join(names)
+
+    @staticmethod
+    def _updateAnnouncement(conf, seats_available):
+        """Add conf to or remove it from the announcement snapshot when
+        seats_available crosses the nearly sold out threshold.
+        """
+        wsck = conf.key.urlsafe()
+        nearly_sold_out = 0 < seats_available <= NEARLY_SOLD_OUT_SEATS
+        snapshot_key = ConferenceApi._announcementSnapshotKey()
+
+        def changes(snapshot):
+            confs = snapshot and snapshot.conferences or {}
+            if nearly_sold_out:
+                return confs.get(wsck) != conf.name
+            return wsck in confs
+
+        # nearly every registration leaves the set as it is: check first
+        # so only actual crossings write the snapshot entity
+        if not changes(snapshot_key.get()):
+            return
+
+        @ndb.transactional()
+        def txn():
+            snapshot = snapshot_key.get()
+            if not changes(snapshot):
+                return False
+            snapshot = snapshot or AnnouncementSnapshot(key=snapshot_key)
+            confs = snapshot.conferences or {}
+            if nearly_sold_out:
+                confs[wsck] = conf.name
+            else:
+                del confs[wsck]
+            snapshot.conferences = confs
+            snapshot.put()
+            return True
+
+        if txn():
+            # the next getAnnouncement rebuilds it from the snapshot
+            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
+
     @staticmethod
     def _cacheAnnouncement():
-        """Create Announcement & assign to memcache; used by
-        memcache cron job & putAnnouncement().
+        """Rebuild the announcement snapshot from the datastore & assign
+        it to memcache; used by the memcache cron job to reconcile any
+        drift in the incremental updates.
         """
         confs = Conference.query(ndb.AND(
-            Conference.seatsAvailable <= 5,
+            Conference.seatsAvailable <= NEARLY_SOLD_OUT_SEATS,
             Conference.seatsAvailable > 0)
         ).fetch(projection=[Conference.name])
-
-        if confs:
-            # If there are almost sold out conferences,
-            # format announcement and set it in memcache
-            announcement = ANNOUNCEMENT_TPL % (
-                ', '.join(conf.name for conf in confs))
-            memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
-        else:
-            # If there are no sold out conferences,
-            # delete the memcache announcements entry
-            announcement = ""
-            memcache.delete(MEMCACHE_ANNOUNCEMENTS_KEY)
-
+        nearly_sold_out = dict((conf.key.urlsafe(), conf.name) for conf in confs)
+
+        @ndb.transactional()
+        def txn():
+            snapshot_key = ConferenceApi._announcementSnapshotKey()
+            snapshot = snapshot_key.get() or AnnouncementSnapshot(key=snapshot_key)
+            if snapshot.conferences != nearly_sold_out:
+                snapshot.conferences = nearly_sold_out
+                snapshot.put()
+            return snapshot
+
+        announcement = ConferenceApi._formatAnnouncement(txn())
+        memcache.set(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
         return announcement
 
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='conference/announcement/get',
                       http_method='GET', name='getAnnouncement')
     def getAnnouncement(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY) or "")
+        """Return Announcement from memcache, rebuilt from the snapshot
+        if memcache lost it."""
+        announcement = memcache.get(MEMCACHE_ANNOUNCEMENTS_KEY)
+        if announcement is None:
+            announcement = self._formatAnnouncement(
+                self._announcementSnapshotKey().get())
+            memcache.add(MEMCACHE_ANNOUNCEMENTS_KEY, announcement)
+        return StringMessage(data=announcement)
 
 
 #  ------ Create Sessions ----------
 
-    def _createSessionObject(self, request):
-        """Create Session object from SessionForm that includes confKey, returning SessionForm/request."""
-        # check if user is logged in and is the creator of the conference
-        # object.
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-        user_id = getUserId(user)
+    @staticmethod
+    def _keyFromWebsafe(websafe, model):
+        """Decode a websafe key of model's kind, raising
+        BadRequestException for malformed keys and keys of another kind."""
+        try:
+            key = ndb.Key(urlsafe=websafe)
+        except (TypeError, ProtocolBufferDecodeError):
+            key = None
+        if not key or key.kind() != model.__name__:
+            raise endpoints.BadRequestException(
+                'Invalid %s key: %s' % (model.__name__.lower(), websafe))
+        return key
 
-        if not request.websafeConferenceKey:
+    def _checkSessionConference(self, conf, wsck, user_id):
+        """Make sure conf exists and is owned by user_id."""
+        # get Conference object from request; bail if not found
+        if not conf:
             raise endpoints.NotFoundException(
-                'No conference key given')
-
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+                'No conference found with key: %s' % wsck)
         if user_id != conf.organizerUserId:
             raise endpoints.UnauthorizedException(
                 'Only the creator of the conference can add sessions')
 
-        # get Conference object from request; bail if not found
-        if not conf:
-            raise endpoints.NotFoundException(
-                'No conference found with key: %s' % request.websafeConferenceKey)
-
+    def _sessionDataFromForm(self, request):
+        """Validate a SessionForm and return the data for a new Session."""
         # Check required fields
         if not request.name:
             raise endpoints.BadRequestException(
@@ -517,6 +707,20 @@ class ConferenceApi(remote.Service):
                 data[df] = DEAFULTS_SESSION[df]
                 setattr(request, df, DEAFULTS_SESSION[df])
 
+        # drop duplicated speakers so each one is counted once
+        seen = set()
+        speakers = []
+        for wsspk in data['speakers']:
+            if wsspk not in seen:
+                seen.add(wsspk)
+                speakers.append(wsspk)
+        request.speakers = speakers
+        if len(speakers) > MAX_SESSION_SPEAKERS:
+            raise endpoints.BadRequestException(
+                "A session can have at most %d speakers" % MAX_SESSION_SPEAKERS)
+        data['speakers'] = [self._keyFromWebsafe(wsspk, Speaker)
+                            for wsspk in speakers]
+
         # convert dates from strings to Date objects; set month based on
         # start_date
         if data['date']:
@@ -527,11 +731,30 @@ class ConferenceApi(remote.Service):
         if data['startTime']:
             data['startTime'] = datetime.strptime(
                 data['startTime'], '%H:%M').time()
+        return data
+
+    def _createSessionObject(self, request):
+        """Create Session object from SessionForm that includes confKey, returning SessionForm/request."""
+        if not request.websafeConferenceKey:
+            raise endpoints.NotFoundException(
+                'No conference key given')
+
+        # the conference read only needs the key, so it runs while the
+        # user is resolved and the form is validated
+        conf_key = self._keyFromWebsafe(request.websafeConferenceKey, Conference)
+        conf_future = conf_key.get_async()
+        user_id = self._ctx.userId
+        data = self._sessionDataFromForm(request)
+
+        # check if user is logged in and is the creator of the conference
+        # object.
+        self._checkSessionConference(conf_future.get_result(),
+                                     request.websafeConferenceKey, user_id)
 
         # allocate key based on unique numerical ID
         # and set conference as ancestor of the session object
-        s_id = Session.allocate_ids(size=1, parent=conf.key)[0]
-        s_key = ndb.Key(Session, s_id, parent=conf.key)
+        s_id = Session.allocate_ids(size=1, parent=conf_key)[0]
+        s_key = ndb.Key(Session, s_id, parent=conf_key)
         safekey = s_key.urlsafe()
         data['key'] = s_key
 
@@ -540,8 +763,8 @@ class ConferenceApi(remote.Service):
         data['websafeSessionKey'] = safekey
         request.websafeSessionKey = safekey
 
-        # create Session
-        Session(**data).put()
+        # create Session, counting it for its speakers
+        self._putNewSession(Session(**data))
 
         # create task for featured speaker endpoint (Task 4)
         taskqueue.add(params={'sess_key': data['websafeSessionKey']},
@@ -549,22 +772,173 @@ class ConferenceApi(remote.Service):
                       )
         return request
 
+    def _createSessionObjects(self, requests):
+        """Create many Session objects from SessionForms, returning them.
+
+        Everything is validated before anything is written; ids are
+        allocated with one range per conference and all sessions are
+        written with a single put_multi.
+        """
+        if not requests:
+            raise endpoints.BadRequestException("No sessions given")
+        if len(requests) > MAX_BULK_SESSIONS:
+            raise endpoints.BadRequestException(
+                "At most %d sessions can be created at once" % MAX_BULK_SESSIONS)
+
+        # group the sessions by conference, keeping the request order
+        by_conf = collections.OrderedDict()
+        for request in requests:
+            if not request.websafeConferenceKey:
+                raise endpoints.NotFoundException(
+                    'No conference key given')
+            by_conf.setdefault(request.websafeConferenceKey, []).append(
+                (request, self._sessionDataFromForm(request)))
+
+        conf_keys = [self._keyFromWebsafe(wsck, Conference) for wsck in by_conf]
+        confs = ndb.get_multi(conf_keys)
+        for wsck, conf in zip(by_conf, confs):
+            self._checkSessionConference(conf, wsck, self._ctx.userId)
+
+        sessions = []
+        speaker_keys = set()
+        tasks = []
+        for conf, items in zip(confs, by_conf.values()):
+            first, last = Session.allocate_ids(size=len(items), parent=conf.key)
+            for s_id, (request, data) in zip(range(first, last + 1), items):
+                s_key = ndb.Key(Session, s_id, parent=conf.key)
+                data['key'] = s_key
+                data['websafeSessionKey'] = request.websafeSessionKey = \
+                    s_key.urlsafe()
+                sessions.append(Session(**data))
+                speaker_keys.update(data['speakers'])
+            # one featured speaker recomputation per conference
+            tasks.append(taskqueue.Task(
+                params={'sess_key': sessions[-1].websafeSessionKey},
+                url='/tasks/featured_speaker'))
+
+        # a batch can feature more speakers than one cross-group
+        # transaction may span, so each speaker's count is recomputed by
+        # a task of its own once the sessions are written
+        tasks.extend(taskqueue.Task(
+            params={'spk_key': spk_key.urlsafe()},
+            url='/tasks/recount_speaker', countdown=SPEAKER_RECOUNT_DELAY)
+            for spk_key in speaker_keys)
+
+        ndb.put_multi(sessions)
+        for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        return requests
+
+    @staticmethod
+    @ndb.tasklet
+    def _countSpeakerSessionsAsync(spk_key):
+        """Count the sessions listing a speaker, including sessions that
+        still store it as a websafe string from before the key migration."""
+        by_key, by_string = yield (
+            Session.query(Session.speakers == spk_key).count_async(),
+            Session.query(ndb.GenericProperty('speakers') ==
+                          spk_key.urlsafe()).count_async())
+        raise ndb.Return(by_key + by_string)
+
+    @staticmethod
+    def _recountSpeakerSessions(wsspk):
+        """Recompute a Speaker's sessionCount from its sessions; run by the
+        recount_speaker task, so a retry rewrites the same count instead
+        of applying a delta twice."""
+        spk_key = ndb.Key(urlsafe=wsspk)
+        count = ConferenceApi._countSpeakerSessionsAsync(spk_key).get_result()
+
+        @ndb.transactional()
+        def txn():
+            spk = spk_key.get()
+            if spk and spk.sessionCount != count:
+                spk.sessionCount = count
+                spk.put()
+        txn()
+
+    @ndb.transactional(xg=True)
+    def _putNewSession(self, sess):
+        """Save a new Session and bump sessionCount of its speakers."""
+        speakers = [spk for spk in ndb.get_multi(sess.speakers) if spk]
+        for spk in speakers:
+            spk.sessionCount += 1
+        ndb.put_multi([sess] + speakers)
+
+    def _getOwnSessionAndSpeaker(self, request, unauthorized_msg):
+        """Return (session, speaker) of a SPK_SESS_REQUEST, checking they
+        exist and that the current user organizes the conference."""
+        if not request.websafeSessionKey or not request.websafeSpeakerKey:
+            raise endpoints.BadRequestException(
+                'You have to provide session and speaker key')
+
+        # the session, speaker and conference reads are independent: issue
+        # them together and resolve the user while they are in flight
+        sess_key = self._keyFromWebsafe(request.websafeSessionKey, Session)
+        spk_key = self._keyFromWebsafe(request.websafeSpeakerKey, Speaker)
+        if not sess_key.parent():
+            raise endpoints.BadRequestException(
+                'Invalid session key: %s' % request.websafeSessionKey)
+        futures = ndb.get_multi_async([sess_key, spk_key, sess_key.parent()])
+        user_id = self._ctx.userId
+        sess, spk, conf = [future.get_result() for future in futures]
+
+        # check their existence
+        if not sess:
+            raise endpoints.NotFoundException(
+                'No session found with key: %s' % request.websafeSessionKey)
+        if not spk:
+            raise endpoints.NotFoundException(
+                'No speaker found with key: %s' % request.websafeSpeakerKey)
+
+        # check user is the owner of the conference/session
+        if not conf or user_id != conf.organizerUserId:
+            raise endpoints.UnauthorizedException(unauthorized_msg)
+        return sess, spk
+
+    @ndb.transactional(xg=True)
+    def _changeSessionSpeaker(self, sess_key, spk_key, add=True):
+        """Add/remove a speaker to/from a session, keeping the speaker's
+        sessionCount in step in the same transaction."""
+        sess, spk = ndb.get_multi([sess_key, spk_key])
+        if add:
+            # check if speaker already listed in session
+            if spk_key in sess.speakers:
+                raise endpoints.BadRequestException(
+                    'Speaker already in session')
+            if len(sess.speakers) >= MAX_SESSION_SPEAKERS:
+                raise endpoints.BadRequestException(
+                    "A session can have at most %d speakers" % MAX_SESSION_SPEAKERS)
+            sess.speakers.append(spk_key)
+            spk.sessionCount += 1
+        else:
+            if spk_key not in sess.speakers:
+                raise endpoints.BadRequestException(
+                    'Speaker not in session!')
+            sess.speakers.remove(spk_key)
+            spk.sessionCount = max(spk.sessionCount - 1, 0)
+        ndb.put_multi([sess, spk])
+        return sess
+
+    @ndb.transactional(xg=True)
+    def _addSpeakersToSession(self, sess_key, spk_keys):
+        """Add speakers to a session in one transaction, keeping their
+        sessionCount in step; speakers already in the session are skipped."""
+        sess = sess_key.get()
+        new_keys = [spk_key for spk_key in spk_keys
+                    if spk_key not in sess.speakers]
+        if len(sess.speakers) + len(new_keys) > MAX_SESSION_SPEAKERS:
+            raise endpoints.BadRequestException(
+                "A session can have at most %d speakers" % MAX_SESSION_SPEAKERS)
+        speakers = [spk for spk in ndb.get_multi(new_keys) if spk]
+        for spk in speakers:
+            sess.speakers.append(spk.key)
+            spk.sessionCount += 1
+        ndb.put_multi([sess] + speakers)
+        return sess
+
     def _copySessionToForm(self, sess):
         """Copy relevant fields from Session to SessionForm."""
-        sf = SessionForm()
-        for field in sf.all_fields():
-            if hasattr(sess, field.name):
-                # convert date and time to string
-                if field.name.endswith('date') or field.name.endswith('Time'):
-                    setattr(sf, field.name, str(getattr(sess, field.name)))
-                # special code for enum type
-                elif field.name == 'session_type':
-                    stype = getattr(sess, field.name)
-                    setattr(sf, field.name, stype)
-                else:
-                    setattr(sf, field.name, getattr(sess, field.name))
-        sf.check_initialized()
-        return sf
+        return serializers.sessionToForm(sess)
 
     @endpoints.method(SessionForm, SessionForm, path='createSession',
                       http_method='POST', name='createSession')
@@ -572,12 +946,18 @@ class ConferenceApi(remote.Service):
         """Create new session."""
         return self._createSessionObject(request)
 
+    @endpoints.method(SessionForms, SessionForms, path='createSessionsBulk',
+                      http_method='POST', name='createSessionsBulk')
+    def createSessionsBulk(self, request):
+        """Create many sessions at once."""
+        return SessionForms(items=self._createSessionObjects(request.items))
+
     @endpoints.method(CONF_GET_REQUEST, SessionForms, path='getConferenceSessions',
                       http_method='GET', name='getConferenceSessions')
     def getConferenceSessions(self, request):
         """Get all sessions in a given conference."""
         # get conference object from websafekey, raise exception if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._keyFromWebsafe(request.websafeConferenceKey, Conference).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
@@ -593,7 +973,7 @@ class ConferenceApi(remote.Service):
     def getConferenceSessionsByType(self, request):
         """Get all sessions in a given conference that match a prticular type."""
         # get conference object from websafekey, raise exception if not found
-        conf = ndb.Key(urlsafe=request.websafeConferenceKey).get()
+        conf = self._keyFromWebsafe(request.websafeConferenceKey, Conference).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % request.websafeConferenceKey)
@@ -612,25 +992,27 @@ class ConferenceApi(remote.Service):
         # query all sessions and refine by speaker using the speaker websafe
         # key
         q = Session.query()
-        q = q.filter(request.websafeSpeakerKey == Session.speakers)
+        spk_key = self._keyFromWebsafe(request.websafeSpeakerKey, Speaker)
+        q = q.filter(Session.speakers == spk_key)
         return SessionForms(items=[self._copySessionToForm(ss) for ss in q])
 
 # -------------- Speaker code (Task 1 extra credit)-----------------
 
-    def _createSpeakerObject(self, request):
-        # check user is logged
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
+    def _speakerDataFromForm(self, request):
+        """Validate a SpeakerForm and return the data for a new Speaker."""
         # check all required fields are provided by user
         if not request.firstName or not request.lastName or not request.institution:
             raise endpoints.BadRequestException("All fields are required")
 
         # convert data from request into dict
-        data = {field.name: getattr(request, field.name)
+        return {field.name: getattr(request, field.name)
                 for field in request.all_fields()}
 
+    def _createSpeakerObject(self, request):
+        # check user is logged
+        self._ctx.requireUser()
+        data = self._speakerDataFromForm(request)
+
         # allocate key based on unique numerical ID
         s_id = Speaker.allocate_ids(size=1)[0]
         spk_key = ndb.Key(Speaker, s_id)
@@ -645,14 +1027,33 @@ class ConferenceApi(remote.Service):
         Speaker(**data).put()
         return request
 
+    def _createSpeakerObjects(self, requests):
+        """Create many Speaker objects with one id range and one put_multi,
+        returning the SpeakerForms with their websafeKey set."""
+        # check user is logged
+        self._ctx.requireUser()
+        if not requests:
+            raise endpoints.BadRequestException("No speakers given")
+        if len(requests) > MAX_BULK_SPEAKERS:
+            raise endpoints.BadRequestException(
+                "At most %d speakers can be created at once" % MAX_BULK_SPEAKERS)
+        # validate everything before writing anything
+        items = [(request, self._speakerDataFromForm(request))
+                 for request in requests]
+
+        first, last = Speaker.allocate_ids(size=len(items))
+        speakers = []
+        for s_id, (request, data) in zip(range(first, last + 1), items):
+            spk_key = ndb.Key(Speaker, s_id)
+            data['key'] = spk_key
+            data['websafeKey'] = request.websafeKey = spk_key.urlsafe()
+            speakers.append(Speaker(**data))
+        ndb.put_multi(speakers)
+        return requests
+
     def _copySpeakerToForm(self, spk):
         ''' Copy Speaker object data into Speaker protorpc form'''
-        spkf = SpeakerForm()
-        for field in spkf.all_fields():
-            if hasattr(spk, field.name):
-                setattr(spkf, field.name, getattr(spk, field.name))
-        spkf.check_initialized()
-        return spkf
+        return serializers.speakerToForm(spk)
 
     @endpoints.method(SpeakerForm, SpeakerForm, path='createSpeaker',
                       http_method='POST', name='createSpeaker')
@@ -660,6 +1061,12 @@ class ConferenceApi(remote.Service):
         """Create new speaker."""
         return self._createSpeakerObject(request)
 
+    @endpoints.method(SpeakerForms, SpeakerForms, path='createSpeakersBulk',
+                      http_method='POST', name='createSpeakersBulk')
+    def createSpeakersBulk(self, request):
+        """Create many speakers at once."""
+        return SpeakerForms(items=self._createSpeakerObjects(request.items))
+
     @endpoints.method(message_types.VoidMessage, SpeakerForms, path='listSpeakers',
                       http_method='GET', name='listSpeakers')
     def listSpeakers(self, request):
@@ -671,139 +1078,149 @@ class ConferenceApi(remote.Service):
                       http_method='POST', name='addSpeakerToSession')
     def addSpeakerToSession(self, request):
         """Add Speaker to Session."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        # get necessary object and check their existence
-        sess = ndb.Key(urlsafe=request.websafeSessionKey).get()
-        spk = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
-        conf = ndb.Key(urlsafe=request.websafeSessionKey).parent().get()
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.websafeSessionKey)
-        if not spk:
-            raise endpoints.NotFoundException(
-                'No speaker found with key: %s' % request.websafeSpeakerKey)
-
-        # check user is the owner of the conference/session
+        sess, spk = self._getOwnSessionAndSpeaker(
+            request, 'Only the creator of the conference can add speakers to a session')
 
-        user_id = getUserId(user)
-        if user_id != conf.organizerUserId:
-            raise endpoints.UnauthorizedException(
-                'Only the creator of the conference can add speakers to a session')
+        # add speaker to session, save and return a SessionForm with the
+        # updated session info
+        sess = self._changeSessionSpeaker(sess.key, spk.key)
+        self._clearFeaturedSpeakers([sess.key.parent()])
+        return self._copySessionToForm(sess)
 
-        # check if speaker already listed in session
-        if request.websafeSpeakerKey in sess.speakers:
+    @endpoints.method(SpeakerSessionForms, SessionForms, path='addSpeakersToSessions',
+                      http_method='POST', name='addSpeakersToSessions')
+    def addSpeakersToSessions(self, request):
+        """Add many (speaker, session) pairs at once."""
+        user_id = self._ctx.userId
+        if not request.items:
+            raise endpoints.BadRequestException("No speakers given")
+        if len(request.items) > MAX_BULK_ASSIGNMENTS:
             raise endpoints.BadRequestException(
-                'Speaker already in session')
-
-        # add speaker to session
-        sess.speakers.append(request.websafeSpeakerKey)
+                "At most %d speakers can be assigned at once" % MAX_BULK_ASSIGNMENTS)
+
+        # group the speakers by session, so all writes to a session happen
+        # in a single transaction
+        by_sess = collections.OrderedDict()
+        for item in request.items:
+            spk_keys = by_sess.setdefault(
+                self._keyFromWebsafe(item.websafeSessionKey, Session), [])
+            spk_key = self._keyFromWebsafe(item.websafeSpeakerKey, Speaker)
+            if spk_key not in spk_keys:
+                spk_keys.append(spk_key)
+
+        # get sessions, speakers and conferences in one batch and check
+        # their existence and ownership before writing anything
+        sess_keys = by_sess.keys()
+        for sess_key in sess_keys:
+            # sessions are always children of their conference
+            if not sess_key.parent():
+                raise endpoints.BadRequestException(
+                    'Invalid session key: %s' % sess_key.urlsafe())
+        spk_keys = list(set(k for keys in by_sess.values() for k in keys))
+        conf_keys = list(set(sess_key.parent() for sess_key in sess_keys))
+        entities = dict(zip(sess_keys + spk_keys + conf_keys,
+                            ndb.get_multi(sess_keys + spk_keys + conf_keys)))
+        for key in sess_keys + spk_keys:
+            if not entities[key]:
+                raise endpoints.NotFoundException(
+                    'No %s found with key: %s' % (key.kind().lower(), key.urlsafe()))
+        for conf_key in conf_keys:
+            conf = entities[conf_key]
+            if not conf or user_id != conf.organizerUserId:
+                raise endpoints.UnauthorizedException(
+                    'Only the creator of the conference can add speakers to a session')
+        # the transactions recheck the cap, but checking it here too keeps
+        # an oversized session from failing the request halfway through
+        for sess_key, keys in by_sess.items():
+            speakers = entities[sess_key].speakers
+            new_keys = [key for key in keys if key not in speakers]
+            if len(speakers) + len(new_keys) > MAX_SESSION_SPEAKERS:
+                raise endpoints.BadRequestException(
+                    "A session can have at most %d speakers" % MAX_SESSION_SPEAKERS)
 
-        # save and return a SessionForm with the updated session info
-        sess.put()
-        return self._copySessionToForm(sess)
+        sessions = [self._addSpeakersToSession(sess_key, keys)
+                    for sess_key, keys in by_sess.items()]
+        self._clearFeaturedSpeakers(conf_keys)
+        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
 
     @endpoints.method(SPK_SESS_REQUEST, SessionForm, path='removeSpeakerFromSession',
                       http_method='DELETE', name='removeSpeakerFromSession')
     def removeSpeakerFromSession(self, request):
         """Remove Speaker from Session."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
-
-        if not request.websafeSessionKey or not request.websafeSpeakerKey:
-            raise endpoints.BadRequestException(
-                'You have to provide session and speaker key')
-
-        # get necessary object and check their existence
-        sess = ndb.Key(urlsafe=request.websafeSessionKey).get()
-        spk = ndb.Key(urlsafe=request.websafeSpeakerKey).get()
-        conf = ndb.Key(urlsafe=request.websafeSessionKey).parent().get()
-        if not sess:
-            raise endpoints.NotFoundException(
-                'No session found with key: %s' % request.websafeSessionKey)
-        if not spk:
-            raise endpoints.NotFoundException(
-                'No speaker found with key: %s' % request.websafeSpeakerKey)
+        sess, spk = self._getOwnSessionAndSpeaker(
+            request, 'Only the creator of the conference can delete speakers from a session')
 
-        # check logged user is the owner of the conference/session
-        user_id = getUserId(user)
-        if user_id != conf.organizerUserId:
-            raise endpoints.UnauthorizedException(
-                'Only the creator of the conference can delete speakers from a session')
-
-        # check if speaker already listed in session
-        if request.websafeSpeakerKey not in sess.speakers:
-            raise endpoints.BadRequestException(
-                'Speaker not in session!')
-
-        # add speaker to session
-        sess.speakers.remove(request.websafeSpeakerKey)
-
-        # save and return a SessionForm with the updated session info
-        sess.put()
+        # remove speaker from session, save and return a SessionForm with
+        # the updated session info
+        sess = self._changeSessionSpeaker(sess.key, spk.key, add=False)
+        self._clearFeaturedSpeakers([sess.key.parent()])
         return self._copySessionToForm(sess)
 
 # ---------------- Session Wishlist (Task 2)-----------------------
 
+    def _getWishlistSessions(self, profile):
+        """Batch-load the sessions in profile's wishlist, skipping deleted ones."""
+        return [sess for sess in ndb.get_multi(profile.wishlist) if sess]
+
+    def _getSessionSpeakers(self, sessions):
+        """Batch-load the distinct speakers featured in sessions, in order."""
+        seen = set()
+        spk_keys = []
+        for sess in sessions:
+            for spk_key in sess.speakers:
+                # avoid repetitions
+                if spk_key not in seen:
+                    seen.add(spk_key)
+                    spk_keys.append(spk_key)
+        return [spk for spk in ndb.get_multi(spk_keys) if spk]
+
     @endpoints.method(SESS_REQUEST, ProfileForm, path='addSessionToWishlist',
                       http_method='POST', name='addSessionToWishlist')
     def addSessionToWishlist(self, request):
         """Adds a session to the wishlist of the logged user"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         profile = self._getProfileFromUser()
 
-        if request.websafeSessionKey in profile.wishlist:
+        sess_key = self._keyFromWebsafe(request.websafeSessionKey, Session)
+        if sess_key in profile.wishlist:
             raise endpoints.BadRequestException("Session already in wishlist")
 
         # check if the user has registered for the conference
-        conf = ndb.Key(urlsafe=request.websafeSessionKey).parent().get()
+        conf_key = sess_key.parent()
+        conf = conf_key.get() if conf_key else None
         if not conf:
             raise endpoints.NotFoundException('Please check the sessionkey')
-        if conf.key.urlsafe() not in profile.conferenceKeysToAttend:
+        if not self._isRegistered(profile, conf.key):
             raise endpoints.BadRequestException(
                 "You have to register for the conference first")
 
         # adds session to wishlist
-        profile.wishlist.append(request.websafeSessionKey)
-        profile.put()
+        profile.wishlist.append(sess_key)
+        self._ctx.putProfile(profile)
         return self._copyProfileToForm(profile)
 
     @endpoints.method(message_types.VoidMessage, SessionForms, path='getSessionsInWishlist',
                       http_method='GET', name='getSessionsInWishlist')
     def getSessionsInWishlist(self, request):
         """Returns the sessions currently in the wishlist of the logged user"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         profile = self._getProfileFromUser()
         if not profile.wishlist:
             raise endpoints.BadRequestException("No sessions in wishlist")
 
-        # retrieves all sessions by its key and builds a list
-        session_list = []
-        for sess in profile.wishlist:
-            obj = ndb.Key(urlsafe=sess).get()
-            session_list.append(obj)
+        # retrieves all sessions by its key in a single batch
+        session_list = self._getWishlistSessions(profile)
         return SessionForms(items=[self._copySessionToForm(sess) for sess in session_list])
 
     @endpoints.method(SESS_REQUEST, ProfileForm, path='deleteSessionInWishlist',
                       http_method='DELETE', name='deleteSessionInWishlist')
     def deleteSessionInWishlist(self, request):
         """Delete session from users' wishlist"""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         profile = self._getProfileFromUser()
 
-        if request.websafeSessionKey not in profile.wishlist:
+        sess_key = self._keyFromWebsafe(request.websafeSessionKey, Session)
+        if sess_key not in profile.wishlist:
             raise endpoints.BadRequestException("Session not in wishlist")
-        profile.wishlist.remove(request.websafeSessionKey)
-        profile.put()
+        profile.wishlist.remove(sess_key)
+        self._ctx.putProfile(profile)
         return self._copyProfileToForm(profile)
 
 
@@ -813,217 +1230,468 @@ class ConferenceApi(remote.Service):
                       http_method='GET', name='listSpeakersInWishlist')
     def listSpeakersInWishlist(self, request):
         """List all speakers that are featured in the sessions currently in the logged user's wishlist."""
-        user = endpoints.get_current_user()
-        if not user:
-            raise endpoints.UnauthorizedException('Authorization required')
         profile = self._getProfileFromUser()
         if not profile.wishlist:
             raise endpoints.BadRequestException("No sessions in wishlist")
 
         # creates a list with the speaker objects references in the sessions
-        # whose key is in the user's wishlis
-        speaker_list = []
-        for sess_key in profile.wishlist:
-            session = ndb.Key(urlsafe=sess_key).get()
-            for speaker_key in session.speakers:
-                spk_obj = ndb.Key(urlsafe=speaker_key).get()
-                # avoid repetitions
-                if spk_obj not in speaker_list:
-                    speaker_list.append(spk_obj)
+        # whose key is in the user's wishlist: one batch for the sessions,
+        # one batch for their speakers
+        sessions = self._getWishlistSessions(profile)
+        speaker_list = self._getSessionSpeakers(sessions)
         return SpeakerForms(items=[self._copySpeakerToForm(spk) for spk in speaker_list])
 
-    @endpoints.method(message_types.VoidMessage, SpeakerForms, path='popularSpeakers', http_method='GET',
+    @endpoints.method(PAGE_REQUEST, SpeakerForms, path='popularSpeakers', http_method='GET',
                       name='popularSpeakers')
     def popularSpeakers(self, request):
         """ List speakers participating in two or more sessions across all conferences """
-        q = Speaker.query()
-        spk_participations = {}
-
-        # builds a dict to include each speaker's key and the times it appears
-        for spk in q:
-            spk_participations[spk.key.urlsafe()] = 0
-
-        # retrieve all sessions and iterate through the speaker's array
-        q = Session.query()
-        for sess in q:
-            for speaker in sess.speakers:
-                # increment the counter when the speaker's key appears
-                spk_participations[speaker] += 1
-
-        popularSpeakers = []
-        # search the dict for the speakers' appearing more than once
-        for (speaker, appeareances) in spk_participations.items():
-            if appeareances >= 2:
-                # append the speakers object to the list
-                popularSpeakers.append(ndb.Key(urlsafe=speaker).get())
-        return SpeakerForms(items=[self._copySpeakerToForm(spk) for spk in popularSpeakers])
-
-    @endpoints.method(message_types.VoidMessage, ConferenceForms, path='successfulConferences',
+        # sessionCount is maintained on every session/speaker write, so this
+        # is a single indexed query
+        q = Speaker.query(Speaker.sessionCount >= POPULAR_SPEAKER_SESSIONS)
+        q = q.order(-Speaker.sessionCount)
+        speakers, next_cursor = self._fetchPage(
+            q, request.pageSize, request.cursor)
+        return SpeakerForms(items=[self._copySpeakerToForm(spk) for spk in speakers],
+                            nextCursor=next_cursor)
+
+    @endpoints.method(OCCUPANCY_REQUEST, ConferenceForms, path='successfulConferences',
                       http_method='GET', name='successfulConferences')
     def successfulConferences(self, request):
-        """ List conferences with more than 95 percent of its seats occupied"""
-        q = Conference.query()
-        conf_list = []
-        for conf in q:
-            # calculate threshold level for inclusion
-            fivepercent = 0.05 * conf.maxAttendees
-            if conf.seatsAvailable < fivepercent:
-                conf_list.append(conf)
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, '') for conf in conf_list])
+        """ List conferences with more than 95 percent (or minOccupancy) of its seats occupied"""
+        min_occupancy = request.minOccupancy
+        if min_occupancy is None:
+            min_occupancy = SUCCESSFUL_OCCUPANCY
+        if not 0 <= min_occupancy <= 1:
+            raise endpoints.BadRequestException(
+                "'minOccupancy' must be between 0 and 1")
+
+        # occupancy is stored on every Conference write, so the threshold
+        # is applied by the index rather than in python
+        q = Conference.query(Conference.occupancy > min_occupancy)
+        q = q.order(-Conference.occupancy)
+        conf_list, next_cursor = self._fetchPage(
+            q, request.pageSize, request.cursor)
+        return ConferenceForms(items=[self._copyConferenceToForm(conf, '') for conf in conf_list],
+                               nextCursor=next_cursor)
+
+    @staticmethod
+    def _parseSearchValue(name, value, fmt):
+        """Parse a date/time search parameter, or return None if not given."""
+        if not value:
+            return None
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            raise endpoints.BadRequestException(
+                "Invalid '%s': %s" % (name, value))
+
+    @staticmethod
+    def _sessionTypesToMatch(include, exclude):
+        """Return the session types a search matches, or None for any type.
+
+        Excluded types ('!=') are rewritten as the remaining members of
+        the SessionType enum; untyped sessions are kept, as '!=' would.
+        """
+        if not include and not exclude:
+            return None
+        types = list(include) if include else list(SessionType) + [None]
+        excluded = set(exclude)
+        return [t for t in types if t not in excluded]
+
+    def _getSessionQuery(self, request):
+        """Plan a session search.
+
+        Returns (query, residual): query is an ancestor query with every
+        predicate Datastore can serve, residual an in-memory check for
+        what it cannot, or None. Datastore allows an inequality on one
+        property only, so the time window stays an inequality and the
+        duration range is expanded into IN over its values when the
+        resulting number of subqueries is small enough; otherwise it is
+        checked on the fetched sessions.
+        """
+        conf = self._keyFromWebsafe(request.websafeConferenceKey, Conference).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+
+        date = self._parseSearchValue('date', request.date, '%Y-%m-%d')
+        after = self._parseSearchValue('startAfter', request.startAfter, '%H:%M')
+        before = self._parseSearchValue('startBefore', request.startBefore, '%H:%M')
+        min_duration = request.minDuration
+        max_duration = request.maxDuration
+
+        q = Session.query(ancestor=conf.key)
+        types = self._sessionTypesToMatch(request.sessionTypes,
+                                          request.excludeSessionTypes)
+        if types is not None:
+            if not types:
+                return None, None
+            if len(types) == 1:
+                q = q.filter(Session.session_type == types[0])
+            else:
+                q = q.filter(Session.session_type.IN(types))
+        if date:
+            q = q.filter(Session.date == date.date())
+
+        residual = None
+        has_duration = min_duration is not None or max_duration is not None
+        if after or before:
+            if after:
+                q = q.filter(Session.startTime >= after.time())
+            if before:
+                q = q.filter(Session.startTime < before.time())
+            if min_duration is not None and max_duration is not None:
+                durations = range(max(min_duration, 0), max_duration + 1)
+                if not durations:
+                    return None, None
+                if len(types or [None]) * len(durations) <= MAX_QUERY_SUBQUERIES:
+                    q = q.filter(Session.duration.IN(durations))
+                    has_duration = False
+            if has_duration:
+                def residual(sess):
+                    return (sess.duration is not None and
+                            (min_duration is None or sess.duration >= min_duration) and
+                            (max_duration is None or sess.duration <= max_duration))
+            q = q.order(Session.startTime)
+        elif has_duration:
+            if min_duration is not None:
+                q = q.filter(Session.duration >= min_duration)
+            if max_duration is not None:
+                q = q.filter(Session.duration <= max_duration)
+            q = q.order(Session.duration, Session.startTime)
+        else:
+            q = q.order(Session.startTime)
+        return q, residual
+
+    def _searchSessions(self, request):
+        """Run a session search, returning SessionForms."""
+        q, residual = self._getSessionQuery(request)
+        if q is None:
+            return SessionForms(items=[])
+        sessions = q if residual is None else (s for s in q if residual(s))
+        return SessionForms(items=[self._copySessionToForm(sess) for sess in sessions])
+
+    @endpoints.method(SessionQueryForm, SessionForms, path='searchSessions',
+                      http_method='POST', name='searchSessions')
+    def searchSessions(self, request):
+        """Search the sessions of a conference by type, date, start time
+        window and duration."""
+        return self._searchSessions(request)
 
     @endpoints.method(CONF_GET_REQUEST, SessionForms, path='early-non-workshop/{websafeConferenceKey}',
                       http_method='GET', name='early-non-workshop')
     def earlynonworkshop(self, request):
         """ Returns all non workshop sessions before 19:00"""
-        # queries all sessions
-        q = Session.query()
-
-        # restrict query to the given conference
-        q = q.filter(Session.websafeConferenceKey ==
-                     request.websafeConferenceKey)
-        # applies first inequality filter
-        q = q.filter(Session.startTime < datetime.strptime(
-            "19:00", '%H:%M').time())
-
-        # second inequality filter processed using programming languange and not query API
-        # approach is building a list and checking inequalities as python
-        # object properties
-        results = []
-        for sess in q:
-            if sess.session_type != SessionType('WORKSHOP'):
-                results.append(sess)
-
-        return SessionForms(items=[self._copySessionToForm(sess) for sess in results])
+        # '!= WORKSHOP' becomes IN over the other session types, leaving
+        # the start time as the only inequality, so a single indexed query
+        # returns exactly the matching sessions
+        return self._searchSessions(SessionQueryForm(
+            websafeConferenceKey=request.websafeConferenceKey,
+            excludeSessionTypes=[SessionType.WORKSHOP],
+            startBefore=EARLY_SESSION_END))
 
 # ----------------- Task 4 - Add a task ------------------------------
 
+    @staticmethod
+    def _getFeaturedSpeakers(conf_key):
+        """Return [(speaker key, message)] for a conference's
+        featured speakers, i.e. those speaking in two or more sessions.
+        """
+        # build a speaker -> session names map from a single ancestor
+        # projection query; projecting the repeated speakers property
+        # yields one result per (session, speaker) pair
+        speaker_sessions = {}
+        q = Session.query(ancestor=conf_key)
+        for sess in q.iter(projection=[Session.name, Session.speakers]):
+            speaker_sessions.setdefault(sess.speakers[0], []).append(sess.name)
+
+        featured = [spk_key for spk_key, names in speaker_sessions.items()
+                    if len(names) > 1]
+
+        # get all featured speaker objects in one batch
+        speakers = ndb.get_multi(featured)
+        announcements = []
+        for spk_key, spk_obj in zip(featured, speakers):
+            if not spk_obj:
+                continue
+            fullname = "%s %s (%s)" % (
+                spk_obj.firstName, spk_obj.lastName, spk_obj.institution)
+            announcements.append((spk_key,
+                "Speaker %s is featured in the following sessions: %s.\n" % (
+                    fullname, ', '.join(speaker_sessions[spk_key]))))
+        return announcements
+
     @staticmethod
     def _cacheFeaturedSpeaker(sess_key):
         """Query DB for featured speakers & assign results to memcache."""
-
         # get session object
         ses_obj = ndb.Key(urlsafe=sess_key).get()
-
-        # get conference object
-        conf = ses_obj.key.parent().get()
-
-        # get all sessions in the conference
-        sessions = Session.query(ancestor=conf.key)
-
-        # here I'll store the message to be set
-        memcache_message = ''
-
-        # for each speaker in participating in the session, check if featured
-        # in other sessions in the same conf
-        for newspeaker in ses_obj.speakers:
-            # check if speaker key is present more than one time in all the
-            # sessions
-            counter = 0
-            session_names = []
-            for session in sessions:
-                if newspeaker in session.speakers:
-                    counter += 1
-                    session_names.append(session.name)
-
-            # has to be 2 or more, since the recently added session would also
-            # be counted
-            if counter > 1:
-                # get speaker object
-                spk_obj = ndb.Key(urlsafe=newspeaker).get()
-                # build message
-                fullname = spk_obj.firstName + " " + \
-                    spk_obj.lastName + " (" + spk_obj.institution + ")"
-                featuredsessions = ', '.join(session_names)
-                addedmessage = "Speaker " + fullname + \
-                    " is featured in the following sessions: " + featuredsessions
-                memcache_message += addedmessage
-            memcache_message += '.\n'
-        # set announcement in memcache
-        memcache.set("FEATURED SPEAKERS", memcache_message)
+        if not ses_obj:
+            return ''
+
+        conf_key = ses_obj.key.parent()
+        announcements = ConferenceApi._getFeaturedSpeakers(conf_key)
+
+        # the conference entry lists all of its featured speakers; the
+        # global entry only the new session's speakers featured elsewhere
+        # in the same conf (the new session itself is counted too)
+        memcache_message = ''.join(msg for spk_key, msg in announcements
+                                   if spk_key in ses_obj.speakers)
+        ConferenceApi._setFeaturedSpeakers(
+            conf_key, ''.join(msg for spk_key, msg in announcements))
+        memcache.set(MEMCACHE_FEATURED_SPEAKERS_KEY, memcache_message)
         return memcache_message
 
+    @staticmethod
+    def _setFeaturedSpeakers(conf_key, message):
+        """Cache a conference's featured speakers, keeping a copy that
+        survives invalidation for reads that lose the recompute race."""
+        cache_key = MEMCACHE_FEATURED_SPEAKERS_TPL % conf_key.urlsafe()
+        memcache.set(cache_key, message, time=FEATURED_SPEAKERS_TTL)
+        memcache.set(cache_key + '_STALE', message)
+
+    @staticmethod
+    def _clearFeaturedSpeakers(conf_keys):
+        """Drop the cached featured speakers of conf_keys after their
+        sessions' speakers changed; the next read recomputes them."""
+        memcache.delete_multi([MEMCACHE_FEATURED_SPEAKERS_TPL % conf_key.urlsafe()
+                               for conf_key in conf_keys])
+
+    @staticmethod
+    def _getCachedFeaturedSpeakers(conf_key):
+        """Return a conference's featured speakers from memcache,
+        recomputing them on a miss.
+
+        A short-lived memcache lock makes sure only one request
+        recomputes; the others don't wait for it, and serve the last
+        known value (or nothing) until it has repopulated the cache.
+        """
+        cache_key = MEMCACHE_FEATURED_SPEAKERS_TPL % conf_key.urlsafe()
+        stale_key = cache_key + '_STALE'
+        lock_key = cache_key + '_LOCK'
+        cached = memcache.get_multi([cache_key, stale_key])
+        if cache_key in cached:
+            return cached[cache_key]
+        if not memcache.add(lock_key, 1, time=FEATURED_SPEAKERS_LOCK_TTL):
+            return cached.get(stale_key, '')
+        try:
+            message = ''.join(msg for spk_key, msg in
+                              ConferenceApi._getFeaturedSpeakers(conf_key))
+            ConferenceApi._setFeaturedSpeakers(conf_key, message)
+        finally:
+            memcache.delete(lock_key)
+        return message
+
     @endpoints.method(message_types.VoidMessage, StringMessage,
                       path='getFeaturedSpeaker',
                       http_method='GET', name='getFeaturedSpeaker')
     def getFeaturedSpeaker(self, request):
-        """Return Announcement from memcache."""
-        return StringMessage(data=memcache.get("FEATURED SPEAKERS") or "")
+        """Return featured speakers of the last session created (any conference)."""
+        return StringMessage(data=memcache.get(MEMCACHE_FEATURED_SPEAKERS_KEY) or "")
+
+    @endpoints.method(CONF_GET_REQUEST, StringMessage,
+                      path='conference/{websafeConferenceKey}/featuredSpeaker',
+                      http_method='GET', name='getConferenceFeaturedSpeaker')
+    def getConferenceFeaturedSpeaker(self, request):
+        """Return featured speakers of the given conference."""
+        conf_key = self._keyFromWebsafe(request.websafeConferenceKey, Conference)
+        # don't compute and cache an empty answer for a missing conference
+        if not conf_key.get():
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        return StringMessage(data=self._getCachedFeaturedSpeakers(conf_key))
 
 
 # - - - Registration - - - - - - - - - - - - - - - - - - - -
 
-    @ndb.transactional(xg=True)
+    @staticmethod
+    def _isRegistered(prof, conf_key):
+        """Whether the Profile is registered for the conference.
+
+        Registrations made before the roster existed are only listed in
+        conferenceKeysToAttend until the registrations backfill has run;
+        the missing Registration is written when one is found.
+        """
+        reg_key = ndb.Key(Registration, conf_key.urlsafe(), parent=prof.key)
+        if reg_key.get():
+            return True
+        if conf_key.urlsafe() not in prof.conferenceKeysToAttend:
+            return False
+        Registration(key=reg_key, conference=conf_key).put()
+        return True
+
     def _conferenceRegistration(self, request, reg=True):
         """Register or unregister user for selected conference."""
-        retval = None
         prof = self._getProfileFromUser()  # get user Profile
+        prof_key = prof.key
 
         # check if conf exists given websafeConfKey
-        # get conference; check that it exists
+        # get conference; check that it exists. The conference is read
+        # outside of the transaction so registrants only contend on the
+        # seat shard they draw, not on the conference entity group.
         wsck = request.websafeConferenceKey
-        conf = ndb.Key(urlsafe=wsck).get()
+        conf = self._keyFromWebsafe(wsck, Conference).get()
         if not conf:
             raise endpoints.NotFoundException(
                 'No conference found with key: %s' % wsck)
 
+        reg_key = ndb.Key(Registration, wsck, parent=prof_key)
+
+        def updateProfile():
+            # runs inside the same transaction as the seat shard write; the
+            # Registration is in the Profile's entity group, so looking it
+            # up by key is a consistent membership check
+            prof, registration = ndb.get_multi([prof_key, reg_key])
+            # legacy registrations are only in conferenceKeysToAttend
+            registered = bool(registration) or wsck in prof.conferenceKeysToAttend
+            if reg:
+                # check if user already registered otherwise add
+                if registered:
+                    raise ConflictException(
+                        "You have already registered for this conference")
+                prof.conferenceKeysToAttend.append(wsck)
+                ndb.put_multi([prof, Registration(key=reg_key, conference=conf.key)])
+            else:
+                if not registered:
+                    raise ConflictException(
+                        "You are not registered for this conference")
+                if wsck in prof.conferenceKeysToAttend:
+                    prof.conferenceKeysToAttend.remove(wsck)
+                prof.put()
+                reg_key.delete()
+            return prof
+
         # register
         if reg:
-            # check if user already registered otherwise add
-            if wsck in prof.conferenceKeysToAttend:
+            if self._isRegistered(prof, conf.key):
                 raise ConflictException(
                     "You have already registered for this conference")
-
-            # check if seats avail
-            if conf.seatsAvailable <= 0:
+            # register user, take away one seat
+            try:
+                prof = seats.reserveSeat(conf, updateProfile)
+            except seats.NoSeatsAvailable:
                 raise ConflictException(
                     "There are no seats available.")
 
-            # register user, take away one seat
-            prof.conferenceKeysToAttend.append(wsck)
-            conf.seatsAvailable -= 1
-            retval = True
-
         # unregister
         else:
             # check if user already registered
-            if wsck in prof.conferenceKeysToAttend:
+            if not self._isRegistered(prof, conf.key):
+                return BooleanMessage(data=False)
+            # unregister user, add back one seat
+            prof = seats.releaseSeat(conf, updateProfile)
+
+        # the transaction has committed: keep the request's Profile current
+        self._ctx.setProfile(prof)
+        memcache.delete(MEMCACHE_ATTENDING_TPL % prof_key.id())
+
+        # fold the shards back into Conference.seatsAvailable shortly
+        self._scheduleSeatSync(wsck)
+        self._invalidateConferenceCache([conf.key])
+        if (conf.seatsAvailable or 0) <= NEARLY_SOLD_OUT_SEATS + ANNOUNCEMENT_CHECK_MARGIN:
+            self._updateAnnouncement(conf, seats.getSeatsAvailable(conf))
+        return BooleanMessage(data=True)
 
-                # unregister user, add back one seat
-                prof.conferenceKeysToAttend.remove(wsck)
-                conf.seatsAvailable += 1
-                retval = True
-            else:
-                retval = False
+    @staticmethod
+    def _scheduleSeatSync(wsck):
+        """Enqueue one seat sync per conference per SEAT_SYNC_INTERVAL."""
+        bucket = int(time.time()) // SEAT_SYNC_INTERVAL
+        try:
+            taskqueue.add(name='sync-seats-%s-%d' % (wsck, bucket),
+                          params={'websafeConferenceKey': wsck},
+                          url='/tasks/sync_seats',
+                          countdown=SEAT_SYNC_INTERVAL
+                          )
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # a sync for this conference is already pending
+            pass
 
-        # write things back to the datastore & return
-        prof.put()
-        conf.put()
-        return BooleanMessage(data=retval)
+    @staticmethod
+    def _syncSeatsAvailable(wsck):
+        """Copy the aggregated shard count into Conference.seatsAvailable;
+        used by the seat sync task so seat queries stay indexed.
+        """
+        conf_key = ndb.Key(urlsafe=wsck)
+        conf = conf_key.get()
+        if not conf:
+            return
+        seats_available = seats.getSeatsAvailable(conf)
+
+        @ndb.transactional()
+        def txn():
+            conf = conf_key.get()
+            conf.seatsAvailable = seats_available
+            conf.put()
+        txn()
+        ConferenceApi._updateAnnouncement(conf, seats_available)
+        return seats_available
+
+    @endpoints.method(CONF_PAGE_REQUEST, AttendeeForms,
+                      path='conference/{websafeConferenceKey}/attendees',
+                      http_method='GET', name='getConferenceAttendees')
+    def getConferenceAttendees(self, request):
+        """List the attendees of a conference, one page at a time; only
+        available to the conference organizer."""
+        conf = self._keyFromWebsafe(request.websafeConferenceKey, Conference).get()
+        if not conf:
+            raise endpoints.NotFoundException(
+                'No conference found with key: %s' % request.websafeConferenceKey)
+        if self._ctx.userId != conf.organizerUserId:
+            raise endpoints.UnauthorizedException(
+                'Only the creator of the conference can list its attendees')
+
+        # registrations are children of the attendees' profiles: page the
+        # roster, then batch-load the profiles
+        q = Registration.query(Registration.conference == conf.key)
+        registrations, next_cursor = self._fetchPage(
+            q, request.pageSize, request.cursor)
+        profiles = ndb.get_multi([reg.key.parent() for reg in registrations])
+        return AttendeeForms(
+            items=[AttendeeForm(displayName=prof.displayName,
+                                mainEmail=prof.mainEmail)
+                   for prof in profiles if prof],
+            nextCursor=next_cursor)
 
     @endpoints.method(message_types.VoidMessage, ConferenceForms,
                       path='conferences/attending',
                       http_method='GET', name='getConferencesToAttend')
     def getConferencesToAttend(self, request):
-        """Get list of conferences that user has registered for."""
-        prof = self._getProfileFromUser()  # get user Profile
-        conf_keys = [ndb.Key(urlsafe=wsck)
-                     for wsck in prof.conferenceKeysToAttend]
-        conferences = ndb.get_multi(conf_keys)
-
-        # get organizers
-        organisers = [ndb.Key(Profile, conf.organizerUserId)
-                      for conf in conferences]
-        profiles = ndb.get_multi(organisers)
-
-        # put display names in a dict for easier fetching
-        names = {}
-        for profile in profiles:
-            names[profile.key.id()] = profile.displayName
+        """Get list of conferences that user has registered for, by start date."""
+        prof = self._getProfileFromUser()
+        prof_key = prof.key
+        # the user's Registrations are keyed by conference, so a keys-only
+        # ancestor query lists them consistently without loading any;
+        # registrations older than the roster are only in the Profile
+        attending = sorted(set(
+            [reg_key.id() for reg_key in
+             Registration.query(ancestor=prof_key).iter(keys_only=True)] +
+            prof.conferenceKeysToAttend))
+
+        # the cached list is only served for the registrations it was
+        # built from, so a write racing a registration can't stick
+        cache_key = MEMCACHE_ATTENDING_TPL % prof_key.id()
+        cached = memcache.get(cache_key)
+        if cached and cached[0] == attending:
+            return protojson.decode_message(ConferenceForms, cached[1])
+
+        # skip conferences deleted since the user registered
+        conf_keys = [ndb.Key(urlsafe=wsck) for wsck in attending]
+        conferences = [conf for conf in ndb.get_multi(conf_keys) if conf]
+        conferences.sort(key=lambda conf: (conf.startDate is None,
+                                           conf.startDate, conf.name))
+
+        # get organizers' display names, once per organizer
+        names = self._getOrganizerNames(
+            conf.organizerUserId for conf in conferences)
 
         # return set of ConferenceForm objects per Conference
-        return ConferenceForms(items=[self._copyConferenceToForm(conf, names[conf.organizerUserId])
-                                      for conf in conferences]
-                               )
+        forms = ConferenceForms(
+            items=[self._copyConferenceToForm(conf, names.get(conf.organizerUserId))
+                   for conf in conferences])
+        memcache.set(cache_key, (attending, protojson.encode_message(forms)),
+                     time=ATTENDING_CACHE_TTL)
+        return forms
 
     @endpoints.method(CONF_GET_REQUEST, BooleanMessage,
                       path='conference/{websafeConferenceKey}',
@@ -0,0 +1,146 @@
+#!/usr/bin/env python
+
+"""exports.py
+
+Batched export of a conference's sessions, speakers and attendees.
+
+Each export walks a Datastore query with cursors, EXPORT_BATCH_SIZE
+results at a time, so only one batch of entities is held in memory.
+A single response stops after about EXPORT_MAX_ROWS rows and hands back the
+cursor to resume from, which keeps every request bounded no matter how
+large the conference is.
+
+"""
+
+import csv
+import json
+
+from google.appengine.ext import ndb
+
+from models import Registration
+from models import Session
+
+EXPORT_BATCH_SIZE = 200
+EXPORT_MAX_ROWS = 5000
+
+FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+COLUMNS = {
+    'sessions': ['websafeSessionKey', 'name', 'date', 'startTime', 'duration',
+                 'session_type', 'speakers', 'highlights'],
+    'speakers': ['websafeKey', 'firstName', 'lastName', 'institution'],
+    'attendees': ['displayName', 'mainEmail'],
+}
+
+
+def _str(value):
+    return None if value is None else str(value)
+
+
+def _sessionRow(sess):
+    return {
+        'websafeSessionKey': sess.key.urlsafe(),
+        'name': sess.name,
+        'date': _str(sess.date),
+        'startTime': _str(sess.startTime),
+        'duration': sess.duration,
+        'session_type': _str(sess.session_type),
+        'speakers': [spk_key.urlsafe() for spk_key in sess.speakers],
+        'highlights': sess.highlights,
+    }
+
+
+def _speakerRow(spk):
+    return {
+        'websafeKey': spk.key.urlsafe(),
+        'firstName': spk.firstName,
+        'lastName': spk.lastName,
+        'institution': spk.institution,
+    }
+
+
+def _attendeeRow(prof):
+    return {
+        'displayName': prof.displayName,
+        'mainEmail': prof.mainEmail,
+    }
+
+
+def _sessions(conf_key, cursor):
+    sessions, cursor, more = Session.query(ancestor=conf_key).fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=cursor)
+    return [_sessionRow(sess) for sess in sessions], cursor, more
+
+
+def _speakers(conf_key, cursor):
+    # a distinct projection on the repeated speakers property returns
+    # each speaker of the conference once, however many sessions it has
+    q = Session.query(ancestor=conf_key)
+    sessions, cursor, more = q.fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=cursor,
+        projection=[Session.speakers], distinct=True)
+    speakers = ndb.get_multi([sess.speakers[0] for sess in sessions])
+    return [_speakerRow(spk) for spk in speakers if spk], cursor, more
+
+
+def _attendees(conf_key, cursor):
+    q = Registration.query(Registration.conference == conf_key)
+    reg_keys, cursor, more = q.fetch_page(
+        EXPORT_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+    profiles = ndb.get_multi([reg_key.parent() for reg_key in reg_keys])
+    return [_attendeeRow(prof) for prof in profiles if prof], cursor, more
+
+
+_BATCHES = {
+    'sessions': _sessions,
+    'speakers': _speakers,
+    'attendees': _attendees,
+}
+
+
+def iterBatches(kind, conf_key, cursor=None, max_rows=EXPORT_MAX_ROWS):
+    """Yield (rows, next cursor) per batch of the kind export of a
+    conference, starting at cursor and stopping at the first batch
+    boundary past max_rows rows.
+
+    The cursor of the last batch is None once the export is complete.
+    """
+    fetch = _BATCHES[kind]
+    rows_done = 0
+    more = True
+    while more and rows_done < max_rows:
+        rows, cursor, more = fetch(conf_key, cursor)
+        rows_done += len(rows)
+        yield rows, cursor if more else None
+
+
+def _encode(value):
+    if isinstance(value, list):
+        value = ';'.join(value)
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return value
+
+
+class Writer(object):
+    """Writes export rows to a file-like object as NDJSON or CSV."""
+
+    def __init__(self, out, kind, fmt, header=True):
+        self.out = out
+        self.columns = COLUMNS[kind]
+        self.csv = None
+        if fmt == 'csv':
+            self.csv = csv.writer(out)
+            if header:
+                self.csv.writerow(self.columns)
+
+    def write(self, rows):
+        for row in rows:
+            if self.csv:
+                self.csv.writerow([_encode(row[col]) for col in self.columns])
+            else:
+                self.out.write(json.dumps(row))
+                self.out.write('\n')
@@ -0,0 +1,248 @@
+#!/usr/bin/env python
+
+"""imports.py
+
+Bulk conference import through task queue fan-out.
+
+An uploaded NDJSON file (one ConferenceForm per line, organizerUserId
+naming the organizer) is split into ImportChunk entities, each handled
+by its own task: ids are allocated with one range per organizer and the
+conferences and their seat shards written with a single put_multi each.
+Every finished chunk is folded into the ImportJob in a transaction and
+then deleted; the last one enqueues the finishing task, which sends
+each organizer a single email.
+
+"""
+
+import hashlib
+from datetime import datetime
+
+import endpoints
+from protorpc import messages
+from protorpc import protojson
+
+from google.appengine.api import taskqueue
+from google.appengine.ext import ndb
+
+import seats
+from conference import ConferenceApi
+from models import Conference
+from models import ConferenceForm
+from models import ImportChunk
+from models import ImportJob
+from models import Profile
+
+IMPORT_CHUNK_ROWS = 500
+# stay well under the 1MB entity size limit
+IMPORT_CHUNK_BYTES = 900 * 1024
+# chunks written per put_multi, keeping each RPC under the request size limit
+IMPORT_PUT_BATCH = 8
+MAX_IMPORT_ERRORS = 100
+
+
+def _chunkKey(job_id, index):
+    return ndb.Key(ImportChunk, '%d:%d' % (job_id, index))
+
+
+def _split(lines):
+    """Yield (first line number, lines) chunks of at most IMPORT_CHUNK_ROWS
+    lines and IMPORT_CHUNK_BYTES bytes."""
+    chunk = []
+    first = size = 0
+    for number, line in lines:
+        line_size = len(line.encode('utf-8')) + 1
+        if chunk and (len(chunk) == IMPORT_CHUNK_ROWS or
+                      size + line_size > IMPORT_CHUNK_BYTES):
+            yield first, chunk
+            chunk = []
+            size = 0
+        if not chunk:
+            first = number
+        chunk.append(line)
+        size += line_size
+    if chunk:
+        yield first, chunk
+
+
+def _addTasks(tasks):
+    for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+        try:
+            taskqueue.Queue().add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+        except (taskqueue.TaskAlreadyExistsError,
+                taskqueue.TombstonedTaskError):
+            # a retried run already enqueued these; the others were added
+            pass
+
+
+def startImport(data, created_by):
+    """Split NDJSON data into chunks and fan them out to import tasks.
+
+    Returns the ImportJob, or None if data has no rows.
+    """
+    # keep the original line numbers for error reports
+    lines = [(number, line) for number, line in
+             enumerate(data.decode('utf-8').splitlines(), 1) if line.strip()]
+    if not lines:
+        return None
+    chunks = list(_split(lines))
+
+    job = ImportJob(createdBy=created_by, totalRows=len(lines),
+                    totalChunks=len(chunks))
+    job.put()
+    job_id = job.key.id()
+
+    entities = [ImportChunk(key=_chunkKey(job_id, index), job=job.key,
+                            index=index, firstLine=first,
+                            lines='\n'.join(chunk))
+                for index, (first, chunk) in enumerate(chunks)]
+    for i in range(0, len(entities), IMPORT_PUT_BATCH):
+        ndb.put_multi(entities[i:i + IMPORT_PUT_BATCH])
+
+    _addTasks([taskqueue.Task(url='/tasks/import_chunk',
+                              params={'chunk': chunk.key.id()})
+               for chunk in entities])
+    return job
+
+
+def _parseRows(chunk):
+    """Return ([(organizer, data)], [error]) for the lines of chunk."""
+    rows = []
+    errors = []
+    for number, line in enumerate(chunk.lines.split('\n'), chunk.firstLine):
+        try:
+            form = protojson.decode_message(ConferenceForm, line)
+            if not form.organizerUserId:
+                raise endpoints.BadRequestException(
+                    "Conference 'organizerUserId' field required")
+            data = ConferenceApi._conferenceDataFromForm(form)
+        except (ValueError, messages.Error,
+                endpoints.BadRequestException) as e:
+            errors.append('line %d: %s' % (number, e))
+            continue
+        rows.append((form.organizerUserId, data))
+    return rows, errors
+
+
+def _allocateKeys(organizers):
+    """Return a Conference key per entry of organizers, allocating one id
+    range per distinct organizer; the allocations run concurrently."""
+    counts = {}
+    for organizer in organizers:
+        counts[organizer] = counts.get(organizer, 0) + 1
+    futures = dict(
+        (organizer, Conference.allocate_ids_async(
+            size=count, parent=ndb.Key(Profile, organizer)))
+        for organizer, count in counts.items())
+    ids = {}
+    for organizer, future in futures.items():
+        first, last = future.get_result()
+        ids[organizer] = iter(range(first, last + 1))
+    return [ndb.Key(Conference, next(ids[organizer]),
+                    parent=ndb.Key(Profile, organizer))
+            for organizer in organizers]
+
+
+def processChunk(chunk_id):
+    """Import the conferences of one chunk and record it on its job."""
+    chunk = ndb.Key(ImportChunk, chunk_id).get()
+    if not chunk:
+        return
+    job = chunk.job.get()
+    if not job or chunk.index in job.chunksDone:
+        # the job was deleted, or an earlier attempt recorded the chunk
+        # but failed to delete it
+        chunk.key.delete()
+        return
+    rows, errors = _parseRows(chunk)
+    organizers = [organizer for organizer, _ in rows]
+
+    existing = []
+    if len(chunk.conferenceKeys) == len(rows):
+        # a retry: conferences an earlier attempt wrote may already have
+        # taken registrations, so they are left as they are
+        existing = [conf for conf in ndb.get_multi(chunk.conferenceKeys)
+                    if conf]
+    else:
+        chunk.conferenceKeys = _allocateKeys(organizers)
+        chunk.put()
+
+    written = set(conf.key for conf in existing)
+    conferences = []
+    for (organizer, data), key in zip(rows, chunk.conferenceKeys):
+        if key not in written:
+            data['key'] = key
+            data['organizerUserId'] = organizer
+            conferences.append(Conference(**data))
+    ndb.put_multi(conferences)
+    seats.initShardsMulti(conferences)
+    if existing:
+        # only fills in shards the earlier attempt didn't get to write
+        seats.initShardsMulti(existing, keep_existing=True)
+
+    counts = {}
+    for organizer in organizers:
+        counts[organizer] = counts.get(organizer, 0) + 1
+    _recordChunk(chunk.job, chunk.index, len(rows), errors, counts)
+    chunk.key.delete()
+
+
+@ndb.transactional(retries=10)
+def _recordChunk(job_key, index, imported, errors, counts):
+    """Fold a finished chunk into its job, once; the last chunk enqueues
+    the finishing task."""
+    job = job_key.get()
+    if not job or index in job.chunksDone:
+        return
+    job.chunksDone.append(index)
+    job.imported += imported
+    job.failed += len(errors)
+    job.errors.extend(errors[:max(MAX_IMPORT_ERRORS - len(job.errors), 0)])
+    organizers = job.organizers or {}
+    for organizer, count in counts.items():
+        organizers[organizer] = organizers.get(organizer, 0) + count
+    job.organizers = organizers
+    if len(job.chunksDone) == job.totalChunks:
+        job.status = 'FINISHING'
+        taskqueue.add(url='/tasks/import_finish',
+                      params={'job': job_key.id()}, transactional=True)
+    job.put()
+
+
+def finishImport(job_id):
+    """Send each organizer of a job one email and mark the job done."""
+    job = ndb.Key(ImportJob, job_id).get()
+    if not job or job.status == 'DONE':
+        return
+    counts = job.organizers or {}
+    organizers = counts.keys()
+    profiles = ndb.get_multi([ndb.Key(Profile, organizer)
+                              for organizer in organizers])
+    # named per job and organizer, so a retried run sends no duplicates;
+    # organizers without a profile have no address to send to
+    _addTasks([taskqueue.Task(
+        url='/tasks/send_import_email',
+        name='import-email-%d-%s' % (
+            job_id, hashlib.md5(organizer.encode('utf-8')).hexdigest()),
+        params={'email': prof.mainEmail, 'count': counts[organizer]})
+        for organizer, prof in zip(organizers, profiles)
+        if prof and prof.mainEmail])
+    job.status = 'DONE'
+    job.finished = datetime.now()
+    job.put()
+
+
+def jobStatus(job):
+    """Return the progress of job as a JSON-serializable dict."""
+    return {
+        'jobId': job.key.id(),
+        'status': job.status,
+        'createdBy': job.createdBy,
+        'created': job.created and job.created.isoformat(),
+        'finished': job.finished and job.finished.isoformat(),
+        'totalRows': job.totalRows,
+        'totalChunks': job.totalChunks,
+        'chunksDone': len(job.chunksDone),
+        'imported': job.imported,
+        'failed': job.failed,
+        'errors': job.errors,
+    }
@@ -12,10 +12,23 @@ created by wesc on 2014 may 24
 
 __author__ = 'wesc+api@google.com (Wesley Chun)'
 
+import json
+
 import webapp2
 from google.appengine.api import app_identity
+from google.appengine.api import datastore_errors
 from google.appengine.api import mail
+from google.appengine.api import users
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from google.net.proto.ProtocolBuffer import ProtocolBufferDecodeError
 from conference import ConferenceApi
+from models import Conference
+from models import ImportJob
+from utils import getUserId
+import backfills
+import exports
+import imports
 
 
 class SetAnnouncementHandler(webapp2.RequestHandler):
@@ -34,6 +47,148 @@ class SetFeaturedSpeakerHandler(webapp2.RequestHandler):
         self.response.set_status(204)
 
 
+class SyncSeatsAvailableHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Fold seat shards back into Conference.seatsAvailable."""
+        ConferenceApi._syncSeatsAvailable(
+            self.request.get('websafeConferenceKey'))
+        self.response.set_status(204)
+
+
+class RecountSpeakerHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Recompute a Speaker's sessionCount after a bulk session create."""
+        ConferenceApi._recountSpeakerSessions(self.request.get('spk_key'))
+        self.response.set_status(204)
+
+
+class BackfillHandler(webapp2.RequestHandler):
+
+    def get(self, name):
+        """Start the named one-off backfill (see backfills.BACKFILLS)."""
+        if name not in backfills.BACKFILLS:
+            self.abort(404, 'No backfill named: %s' % name)
+        backfills.startBackfill(name)
+        self.response.set_status(202)
+
+    def post(self, name):
+        """Run one page of a backfill, enqueueing the next page."""
+        backfills.runBackfill(
+            name, self.request.get('run'), int(self.request.get('stage')),
+            int(self.request.get('page')), self.request.get('cursor'))
+        self.response.set_status(204)
+
+
+class ExportConferenceHandler(webapp2.RequestHandler):
+
+    def get(self, wsck, kind):
+        """Export a conference's sessions, speakers or attendees.
+
+        Writes about exports.EXPORT_MAX_ROWS rows as NDJSON (default) or
+        CSV (?format=csv). If there are more, the X-Export-Cursor header
+        holds the token to pass back as ?cursor= to resume.
+        """
+        try:
+            conf_key = ndb.Key(urlsafe=wsck)
+        except (TypeError, ProtocolBufferDecodeError):
+            conf_key = None
+        conf = conf_key.get() if conf_key and conf_key.kind() == Conference.__name__ else None
+        if not conf:
+            self.abort(404, 'No conference found with key: %s' % wsck)
+        user = users.get_current_user()
+        if not user or getUserId(user) != conf.organizerUserId:
+            self.abort(403, 'Only the creator of the conference can export it')
+
+        fmt = self.request.get('format', 'ndjson')
+        if fmt not in exports.FORMATS:
+            self.abort(400, 'Unknown format: %s' % fmt)
+        token = self.request.get('cursor')
+        try:
+            cursor = Cursor(urlsafe=token) if token else None
+        except datastore_errors.BadValueError:
+            self.abort(400, 'Invalid cursor: %s' % token)
+
+        self.response.content_type = exports.FORMATS[fmt]
+        writer = exports.Writer(self.response.out, kind, fmt, header=not token)
+        next_cursor = None
+        for rows, next_cursor in exports.iterBatches(kind, conf_key, cursor):
+            writer.write(rows)
+        if next_cursor:
+            self.response.headers['X-Export-Cursor'] = next_cursor.urlsafe()
+
+
+def _writeJson(response, data, status=200):
+    response.set_status(status)
+    response.content_type = 'application/json'
+    response.write(json.dumps(data))
+
+
+class ImportConferencesHandler(webapp2.RequestHandler):
+
+    def get(self):
+        """List the current user's recent import jobs."""
+        jobs = ImportJob.query(
+            ImportJob.createdBy == users.get_current_user().email()
+        ).order(-ImportJob.created).fetch(20)
+        _writeJson(self.response,
+                   {'jobs': [imports.jobStatus(job) for job in jobs]})
+
+    def post(self):
+        """Start importing an uploaded NDJSON file of conferences, either
+        the request body or a 'file' form field."""
+        upload = self.request.POST.get('file')
+        data = upload.file.read() if hasattr(upload, 'file') else self.request.body
+        try:
+            job = imports.startImport(data, users.get_current_user().email())
+        except UnicodeDecodeError:
+            self.abort(400, 'The upload is not UTF-8 encoded')
+        if not job:
+            self.abort(400, 'No conferences given')
+        _writeJson(self.response, imports.jobStatus(job), status=202)
+
+
+class ImportJobHandler(webapp2.RequestHandler):
+
+    def get(self, job_id):
+        """Return the progress of an import job."""
+        job = ImportJob.get_by_id(int(job_id))
+        if not job:
+            self.abort(404, 'No import job found with id: %s' % job_id)
+        _writeJson(self.response, imports.jobStatus(job))
+
+
+class ImportChunkHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Import one chunk of an import job."""
+        imports.processChunk(self.request.get('chunk'))
+        self.response.set_status(204)
+
+
+class ImportFinishHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Email the organizers of a finished import job."""
+        imports.finishImport(int(self.request.get('job')))
+        self.response.set_status(204)
+
+
+class SendImportEmailHandler(webapp2.RequestHandler):
+
+    def post(self):
+        """Send email telling an organizer their conferences were imported."""
+        mail.send_mail(
+            'noreply@%s.appspotmail.com' % (
+                app_identity.get_application_id()),     # from
+            self.request.get('email'),                  # to
+            'Your conferences were imported',           # subj
+            'Hi, %s of your conferences were imported '  # body
+            'into the conference catalog.' % self.request.get('count')
+        )
+
+
 class SendConfirmationEmailHandler(webapp2.RequestHandler):
 
     def post(self):
@@ -53,4 +208,14 @@ app = webapp2.WSGIApplication([
     ('/crons/set_announcement', SetAnnouncementHandler),
     ('/tasks/send_confirmation_email', SendConfirmationEmailHandler),
     ('/tasks/featured_speaker', SetFeaturedSpeakerHandler),
+    ('/tasks/sync_seats', SyncSeatsAvailableHandler),
+    ('/tasks/recount_speaker', RecountSpeakerHandler),
+    (r'/tasks/backfill/(\w+)', BackfillHandler),
+    ('/export/conference/([^/]+)/(sessions|speakers|attendees)',
+     ExportConferenceHandler),
+    ('/import/conferences', ImportConferencesHandler),
+    (r'/import/conferences/(\d+)', ImportJobHandler),
+    ('/tasks/import_chunk', ImportChunkHandler),
+    ('/tasks/import_finish', ImportFinishHandler),
+    ('/tasks/send_import_email', SendImportEmailHandler),
 ], debug=True)
@@ -25,13 +25,26 @@ class ConflictException(endpoints.ServiceException):
     http_status = httplib.CONFLICT
 
 
+class KeyListProperty(ndb.KeyProperty):
+    """KeyProperty that can also read values stored as websafe key strings.
+
+    Entities written before Session.speakers and Profile.wishlist held
+    keys still load; putting them again stores real keys.
+    """
+
+    def _db_get_value(self, v, p):
+        if v.has_stringvalue():
+            return ndb.Key(urlsafe=v.stringvalue())
+        return super(KeyListProperty, self)._db_get_value(v, p)
+
+
 class Profile(ndb.Model):
     """Profile -- User profile object"""
     displayName = ndb.StringProperty()
     mainEmail = ndb.StringProperty()
     teeShirtSize = ndb.StringProperty(default='NOT_SPECIFIED')
     conferenceKeysToAttend = ndb.StringProperty(repeated=True)
-    wishlist = ndb.StringProperty(repeated=True)
+    wishlist = KeyListProperty(kind='Session', repeated=True)
 
 
 class ProfileMiniForm(messages.Message):
@@ -49,6 +62,29 @@ class ProfileForm(messages.Message):
     wishlist = messages.StringField(5, repeated=True)
 
 
+class Registration(ndb.Model):
+    """Registration -- a Profile's registration for a Conference.
+
+    Child of the attendee's Profile, with the websafeConferenceKey as id:
+    the conferences of a user are an ancestor query, the attendees of a
+    conference a query on conference.
+    """
+    conference = ndb.KeyProperty(kind='Conference', required=True)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+
+class AttendeeForm(messages.Message):
+    """AttendeeForm -- conference attendee outbound form message"""
+    displayName = messages.StringField(1)
+    mainEmail = messages.StringField(2)
+
+
+class AttendeeForms(messages.Message):
+    """AttendeeForms -- multiple AttendeeForm outbound form message"""
+    items = messages.MessageField(AttendeeForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
+
 class StringMessage(messages.Message):
     """StringMessage-- outbound (single) string message"""
     data = messages.StringField(1, required=True)
@@ -71,6 +107,49 @@ class Conference(ndb.Model):
     endDate = ndb.DateProperty()
     maxAttendees = ndb.IntegerProperty()
     seatsAvailable = ndb.IntegerProperty()
+    # share of seats taken, recomputed on every put so it can be queried
+    occupancy = ndb.ComputedProperty(
+        lambda self: (1.0 - float(self.seatsAvailable or 0) / self.maxAttendees
+                      if self.maxAttendees else 0.0))
+
+
+class SeatShard(ndb.Model):
+    """SeatShard -- one slice of a Conference's available seats"""
+    seatsAvailable = ndb.IntegerProperty(default=0, indexed=False)
+
+
+class AnnouncementSnapshot(ndb.Model):
+    """AnnouncementSnapshot -- persisted set of nearly sold out conferences"""
+    # websafeConferenceKey -> conference name
+    conferences = ndb.JsonProperty(indexed=False)
+
+
+class ImportJob(ndb.Model):
+    """ImportJob -- progress of a bulk conference import"""
+    createdBy = ndb.StringProperty()
+    created = ndb.DateTimeProperty(auto_now_add=True)
+    finished = ndb.DateTimeProperty()
+    status = ndb.StringProperty(default='RUNNING')
+    totalRows = ndb.IntegerProperty(default=0, indexed=False)
+    totalChunks = ndb.IntegerProperty(default=0, indexed=False)
+    chunksDone = ndb.IntegerProperty(repeated=True, indexed=False)
+    imported = ndb.IntegerProperty(default=0, indexed=False)
+    failed = ndb.IntegerProperty(default=0, indexed=False)
+    errors = ndb.StringProperty(repeated=True, indexed=False)
+    # organizer user id -> number of conferences imported for them
+    organizers = ndb.JsonProperty(indexed=False)
+
+
+class ImportChunk(ndb.Model):
+    """ImportChunk -- one slice of the NDJSON rows of an ImportJob"""
+    job = ndb.KeyProperty(kind='ImportJob', indexed=False)
+    index = ndb.IntegerProperty(indexed=False)
+    firstLine = ndb.IntegerProperty(indexed=False)
+    lines = ndb.TextProperty()
+    # allocated on the first attempt, so a retried chunk rewrites the
+    # same conferences instead of duplicating them
+    conferenceKeys = ndb.KeyProperty(kind='Conference', repeated=True,
+                                     indexed=False)
 
 
 class ConferenceForm(messages.Message):
@@ -92,6 +171,8 @@ class ConferenceForm(messages.Message):
 class ConferenceForms(messages.Message):
     """ConferenceForms -- multiple Conference outbound form message"""
     items = messages.MessageField(ConferenceForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+    queryPlan = messages.StringField(3)
 
 
 class TeeShirtSize(messages.Enum):
@@ -123,6 +204,9 @@ class ConferenceQueryForm(messages.Message):
 class ConferenceQueryForms(messages.Message):
     """ConferenceQueryForms -- multiple ConferenceQueryForm inbound form message"""
     filters = messages.MessageField(ConferenceQueryForm, 1, repeated=True)
+    pageSize = messages.IntegerField(2, variant=messages.Variant.INT32)
+    cursor = messages.StringField(3)
+    explain = messages.BooleanField(4)
 
 # Classes definition for session
 
@@ -139,7 +223,7 @@ class Session(ndb.Model):
     """Session -- Session object"""
     name = ndb.StringProperty(required=True)
     highlights = ndb.StringProperty()
-    speakers = ndb.StringProperty(repeated=True)
+    speakers = KeyListProperty(kind='Speaker', repeated=True)
     duration = ndb.IntegerProperty()
     date = ndb.DateProperty()
     startTime = ndb.TimeProperty()
@@ -166,12 +250,25 @@ class SessionForms(messages.Message):
     items = messages.MessageField(SessionForm, 1, repeated=True)
 
 
+class SessionQueryForm(messages.Message):
+    """SessionQueryForm -- Session search inbound form message"""
+    websafeConferenceKey = messages.StringField(1, required=True)
+    sessionTypes = messages.EnumField(SessionType, 2, repeated=True)
+    excludeSessionTypes = messages.EnumField(SessionType, 3, repeated=True)
+    date = messages.StringField(4)
+    startAfter = messages.StringField(5)
+    startBefore = messages.StringField(6)
+    minDuration = messages.IntegerField(7, variant=messages.Variant.INT32)
+    maxDuration = messages.IntegerField(8, variant=messages.Variant.INT32)
+
+
 class Speaker(ndb.Model):
     """Speaker - Speaker object"""
     firstName = ndb.StringProperty(required=True)
     lastName = ndb.StringProperty(required=True)
     institution = ndb.StringProperty()
     websafeKey = ndb.StringProperty()
+    sessionCount = ndb.IntegerProperty(default=0)
 
 
 class SpeakerForm(messages.Message):
@@ -185,3 +282,15 @@ class SpeakerForm(messages.Message):
 class SpeakerForms(messages.Message):
     """SpeakersForms -- multiple Speaker outbound form message"""
     items = messages.MessageField(SpeakerForm, 1, repeated=True)
+    nextCursor = messages.StringField(2)
+
+
+class SpeakerSessionForm(messages.Message):
+    """SpeakerSessionForm -- (speaker, session) pair inbound form message"""
+    websafeSpeakerKey = messages.StringField(1, required=True)
+    websafeSessionKey = messages.StringField(2, required=True)
+
+
+class SpeakerSessionForms(messages.Message):
+    """SpeakerSessionForms -- multiple SpeakerSessionForm inbound form message"""
+    items = messages.MessageField(SpeakerSessionForm, 1, repeated=True)
@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+
+"""planner.py
+
+Query planner for conference searches.
+
+Of the filters in a ConferenceQueryForms, the planner pushes to
+Datastore only what a small, fixed set of composite indexes can serve:
+
+- with no inequality, every equality filter (Datastore merge-joins the
+  (field, name) indexes, so any combination works)
+- otherwise the most selective equality filter plus all filters on the
+  most selective numeric inequality field, served by a
+  (field, inequality field, name) index
+
+Everything else becomes a residual predicate checked on each entity as
+the query streams, so richer combinations, several inequality fields
+included, need no extra indexes.
+
+"""
+
+import operator
+
+import endpoints
+from google.appengine.ext import ndb
+
+from models import Conference
+
+OPERATORS = {
+    'EQ':   '=',
+    'GT':   '>',
+    'GTEQ': '>=',
+    'LT':   '<',
+    'LTEQ': '<=',
+    'NE':   '!='
+}
+
+FIELDS = {
+    'CITY': 'city',
+    'TOPIC': 'topics',
+    'MONTH': 'month',
+    'MAX_ATTENDEES': 'maxAttendees',
+}
+
+INT_FIELDS = ('month', 'maxAttendees')
+
+# only numeric fields get an inequality index; string ranges on city or
+# topics are rare and are checked as residual predicates instead
+INEQUALITY_FIELDS = INT_FIELDS
+
+# rough share of conferences an equality on each field matches, used to
+# pick the filter Datastore runs; lower is more selective
+EQUALITY_SELECTIVITY = {
+    'city': 0.05,
+    'maxAttendees': 0.05,
+    'month': 1 / 12.0,
+    'topics': 0.1,
+}
+RANGE_SELECTIVITY = 0.25
+BOUND_SELECTIVITY = 0.5
+
+_COMPARE = {
+    '=': operator.eq,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '!=': operator.ne,
+}
+
+
+class Filter(object):
+    """One parsed conference filter."""
+
+    def __init__(self, field, op, value):
+        self.field = field
+        self.op = op
+        self.value = value
+
+    def node(self):
+        return ndb.query.FilterNode(self.field, self.op, self.value)
+
+    def matches(self, conf):
+        """Check conf as Datastore would: a repeated property matches
+        when any of its values does; missing values never match."""
+        values = getattr(conf, self.field)
+        if not isinstance(values, list):
+            values = [values]
+        compare = _COMPARE[self.op]
+        return any(compare(v, self.value) for v in values if v is not None)
+
+    def __str__(self):
+        return '%s %s %r' % (self.field, self.op, self.value)
+
+
+class QueryPlan(object):
+    """A Datastore query plus the residual filters it leaves unchecked."""
+
+    def __init__(self, pushed, inequality_field, residual):
+        self.pushed = pushed
+        self.inequalityField = inequality_field
+        self.residualFilters = residual
+
+        q = Conference.query()
+        for filtr in pushed:
+            q = q.filter(filtr.node())
+        if inequality_field:
+            q = q.order(ndb.GenericProperty(inequality_field))
+        self.query = q.order(Conference.name)
+
+    def residual(self, conf):
+        """Return whether conf passes every filter not run by Datastore."""
+        return all(filtr.matches(conf) for filtr in self.residualFilters)
+
+    def indexes(self):
+        """Return the indexes the query reads, as 'Conference(a, b)'."""
+        order = ([self.inequalityField] if self.inequalityField else []) + ['name']
+        equalities = [f.field for f in self.pushed if f.op == '=']
+        if not equalities:
+            return ['Conference(%s)' % ', '.join(order)]
+        return ['Conference(%s)' % ', '.join([field] + order)
+                for field in sorted(set(equalities))]
+
+    def explain(self):
+        """Describe the plan in one line."""
+        indexes = self.indexes()
+        if len(indexes) > 1:
+            text = 'merge join of ' + ' + '.join(indexes)
+        else:
+            text = 'index ' + indexes[0]
+        if self.pushed:
+            text += ' where ' + ' and '.join(str(f) for f in self.pushed)
+        if self.residualFilters:
+            text += '; post-filter ' + ' and '.join(
+                str(f) for f in self.residualFilters)
+        return text
+
+
+def parseFilters(forms):
+    """Parse, check validity and convert user supplied filters."""
+    filters = []
+    for form in forms:
+        try:
+            field = FIELDS[form.field]
+            op = OPERATORS[form.operator]
+        except KeyError:
+            raise endpoints.BadRequestException(
+                "Filter contains invalid field or operator.")
+        value = form.value
+        if field in INT_FIELDS:
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise endpoints.BadRequestException(
+                    "Filter on '%s' needs a number, got: %s" % (form.field, value))
+        filters.append(Filter(field, op, value))
+    return filters
+
+
+def _inequalitySelectivity(filters):
+    """Estimate the share of conferences matched by the range filters
+    on a single field."""
+    ops = set(f.op for f in filters)
+    if ops & set(['>', '>=']) and ops & set(['<', '<=']):
+        return RANGE_SELECTIVITY
+    return BOUND_SELECTIVITY
+
+
+def plan(forms):
+    """Return the QueryPlan for a list of ConferenceQueryForm."""
+    filters = parseFilters(forms)
+    equalities = [f for f in filters if f.op == '=']
+
+    # group usable inequalities ('!=' matches nearly everything and runs
+    # as two queries, so it is never worth an index) by field
+    ranges = {}
+    for filtr in filters:
+        if filtr.op not in ('=', '!=') and filtr.field in INEQUALITY_FIELDS:
+            ranges.setdefault(filtr.field, []).append(filtr)
+    inequality_field = None
+    if ranges:
+        inequality_field = min(
+            sorted(ranges), key=lambda field: _inequalitySelectivity(ranges[field]))
+        # an equality on the range field itself is left to the post-filter
+        equalities = [f for f in equalities if f.field != inequality_field]
+
+    if inequality_field is None:
+        pushed = equalities
+    else:
+        pushed = list(ranges[inequality_field])
+        if equalities:
+            pushed.insert(0, min(
+                equalities, key=lambda f: EQUALITY_SELECTIVITY[f.field]))
+
+    residual = [f for f in filters if f not in pushed]
+    return QueryPlan(pushed, inequality_field, residual)
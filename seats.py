@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+"""seats.py
+
+Sharded seat counter for conference registration.
+
+Each Conference's available seats are split across NUM_SEAT_SHARDS
+SeatShard root entities, so concurrent registrations only contend when
+they land on the same shard. A seat is taken by decrementing a single
+non-empty shard inside a transaction, which means a conference can
+never be oversold.
+
+"""
+
+import random
+
+from google.appengine.ext import ndb
+
+from models import SeatShard
+
+NUM_SEAT_SHARDS = 20
+
+
+class NoSeatsAvailable(Exception):
+    """Raised when every shard of a conference is empty."""
+
+
+class _ShardTaken(Exception):
+    """Internal: the chosen shard was emptied by a concurrent reservation."""
+
+
+def _shardKeys(conf_key, num_shards=NUM_SEAT_SHARDS):
+    """Return the SeatShard keys of a conference.
+
+    Shards are root entities (not children of the conference) so each
+    one is its own entity group.
+    """
+    wsck = conf_key.urlsafe()
+    return [ndb.Key(SeatShard, '%s:%d' % (wsck, i))
+            for i in range(num_shards)]
+
+
+def _split(seats, num_shards=NUM_SEAT_SHARDS):
+    """Split seats as evenly as possible across shards."""
+    seats = max(seats or 0, 0)
+    base, extra = divmod(seats, num_shards)
+    return [base + 1 if i < extra else base for i in range(num_shards)]
+
+
+def _newShards(conf_key, seats):
+    return [SeatShard(key=key, seatsAvailable=count)
+            for key, count in zip(_shardKeys(conf_key), _split(seats))]
+
+
+def initShards(conf_key, seats):
+    """(Re)set the shards of a conference to hold seats in total."""
+    shards = _newShards(conf_key, seats)
+    ndb.put_multi(shards)
+    return shards
+
+
+def initShardsMulti(confs, keep_existing=False):
+    """Create the shards of many conferences with a single put_multi,
+    each holding the conference's seatsAvailable.
+
+    With keep_existing, shards already written (say by an earlier
+    attempt of the same import) are left alone, so seats taken since
+    are not handed out again.
+    """
+    shards = []
+    for conf in confs:
+        shards.extend(_newShards(conf.key, conf.seatsAvailable))
+    if keep_existing:
+        existing = ndb.get_multi([shard.key for shard in shards])
+        shards = [shard for shard, old in zip(shards, existing) if old is None]
+    ndb.put_multi(shards)
+
+
+def _getShards(conf):
+    """Return the shards of conf, lazily creating them for older entities."""
+    keys = _shardKeys(conf.key)
+    shards = ndb.get_multi(keys)
+    if all(shard is None for shard in shards):
+        # conference predates sharding: seed the shards from the entity;
+        # get_or_insert keeps concurrent seeding from double counting
+        shards = [SeatShard.get_or_insert(key.id(), seatsAvailable=count)
+                  for key, count in zip(keys, _split(conf.seatsAvailable))]
+    return shards
+
+
+def getSeatsAvailable(conf):
+    """Return the aggregated number of seats available for conf."""
+    return sum(shard.seatsAvailable for shard in _getShards(conf) if shard)
+
+
+def _adjust(shard_key, delta, txn_work):
+    """Apply delta to one shard (and run txn_work) in one transaction."""
+    @ndb.transactional(xg=txn_work is not None)
+    def txn():
+        shard = shard_key.get()
+        if shard is None or shard.seatsAvailable + delta < 0:
+            raise _ShardTaken()
+        shard.seatsAvailable += delta
+        result = txn_work() if txn_work else None
+        shard.put()
+        return result
+    return txn()
+
+
+def reserveSeat(conf, txn_work=None):
+    """Take one seat of conf from a random non-empty shard.
+
+    txn_work, if given, is called inside the same transaction as the
+    shard write so callers can update their own entities atomically;
+    its return value is returned. Raises NoSeatsAvailable when the
+    conference is sold out.
+    """
+    shards = _getShards(conf)
+    candidates = [s.key for s in shards if s and s.seatsAvailable > 0]
+    random.shuffle(candidates)
+    for shard_key in candidates:
+        try:
+            return _adjust(shard_key, -1, txn_work)
+        except _ShardTaken:
+            # another registrant emptied this shard first; try the next one
+            continue
+    raise NoSeatsAvailable()
+
+
+def adjustSeats(conf, delta):
+    """Add delta seats to conf, say when maxAttendees changes.
+
+    Seats are added to a single random shard. Seats are removed from the
+    fullest shards first, each in its own transaction, and never below
+    zero; returns the number of seats actually removed or added.
+    """
+    shards = ndb.get_multi(_shardKeys(conf.key))
+    if all(shard is None for shard in shards):
+        # not seeded yet: the shards will be seeded from the entity, which
+        # already holds the new count
+        return delta
+    if delta >= 0:
+        _adjust(random.choice(_shardKeys(conf.key)), delta, None)
+        return delta
+    removed = 0
+    for shard in sorted((s for s in shards if s), reverse=True,
+                        key=lambda s: s.seatsAvailable):
+        removed += _take(shard.key, -delta - removed)
+        if removed == -delta:
+            break
+    return -removed
+
+
+@ndb.transactional()
+def _take(shard_key, seats):
+    """Take up to seats from one shard; return how many were taken."""
+    shard = shard_key.get()
+    taken = min(seats, shard.seatsAvailable if shard else 0)
+    if taken:
+        shard.seatsAvailable -= taken
+        shard.put()
+    return taken
+
+
+def releaseSeat(conf, txn_work=None):
+    """Give one seat of conf back to a random shard.
+
+    txn_work behaves as in reserveSeat().
+    """
+    _getShards(conf)
+    return _adjust(random.choice(_shardKeys(conf.key)), 1, txn_work)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+"""serializers.py
+
+Fast-path copies of datastore entities into their ProtoRPC forms.
+
+The field mapping of each (model, form) pair is worked out once at
+import time, so serializing an entity is a flat list of attribute
+reads instead of a reflective walk over form.all_fields().
+
+"""
+
+from operator import attrgetter
+
+from models import Conference
+from models import ConferenceForm
+from models import Profile
+from models import ProfileForm
+from models import Session
+from models import SessionForm
+from models import Speaker
+from models import SpeakerForm
+from models import TeeShirtSize
+
+
+class _Serializer(object):
+    """Copies the fields shared by a model and a form, plus any fields
+    with an explicit converter."""
+
+    def __init__(self, model_cls, form_cls, converters=None):
+        converters = converters or {}
+        self.form_cls = form_cls
+        self.getters = []
+        for field in form_cls.all_fields():
+            if field.name in converters:
+                self.getters.append((field.name, converters[field.name]))
+            elif hasattr(model_cls, field.name):
+                self.getters.append((field.name, attrgetter(field.name)))
+        # forms without required fields can never fail check_initialized()
+        self.check = any(field.required for field in form_cls.all_fields())
+
+    def __call__(self, entity, **extra):
+        values = dict((name, getter(entity)) for name, getter in self.getters)
+        values.update(extra)
+        form = self.form_cls(**values)
+        if self.check:
+            form.check_initialized()
+        return form
+
+
+def _str(name):
+    """Converter: attribute as a string (dates and times)."""
+    get = attrgetter(name)
+    return lambda entity: str(get(entity))
+
+
+_conference = _Serializer(Conference, ConferenceForm, {
+    'startDate': _str('startDate'),
+    'endDate': _str('endDate'),
+    'websafeKey': lambda conf: conf.key.urlsafe(),
+})
+
+
+def _urlsafe(name):
+    """Converter: key list attribute as websafe key strings."""
+    get = attrgetter(name)
+    return lambda entity: [key.urlsafe() for key in get(entity)]
+
+
+_session = _Serializer(Session, SessionForm, {
+    'date': _str('date'),
+    'startTime': _str('startTime'),
+    'speakers': _urlsafe('speakers'),
+})
+
+_profile = _Serializer(Profile, ProfileForm, {
+    'teeShirtSize': lambda prof: getattr(TeeShirtSize, prof.teeShirtSize),
+    'wishlist': _urlsafe('wishlist'),
+})
+
+_speaker = _Serializer(Speaker, SpeakerForm)
+
+
+def conferenceToForm(conf, displayName=None):
+    """Copy relevant fields from Conference to ConferenceForm."""
+    if displayName:
+        return _conference(conf, organizerDisplayName=displayName)
+    return _conference(conf)
+
+
+def sessionToForm(sess):
+    """Copy relevant fields from Session to SessionForm."""
+    return _session(sess)
+
+
+def profileToForm(prof):
+    """Copy relevant fields from Profile to ProfileForm."""
+    return _profile(prof)
+
+
+def speakerToForm(spk):
+    """Copy relevant fields from Speaker to SpeakerForm."""
+    return _speaker(spk)
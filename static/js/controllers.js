@@ -346,15 +346,72 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     $scope.pagination = $scope.pagination || {};
     $scope.pagination.currentPage = 0;
     $scope.pagination.pageSize = 20;
+
+    /**
+     * Whether the pages come from the server (the 'ALL' tab) rather than being sliced out of
+     * $scope.conferences locally.
+     * @type {boolean}
+     */
+    $scope.pagination.server = false;
+
+    /**
+     * The conferences of each server page fetched so far, indexed by page number.
+     * @type {Array}
+     */
+    $scope.pagination.pages = [];
+
+    /**
+     * The cursor to pass to conference.queryConferences for each page; cursors[0] is null.
+     * @type {Array}
+     */
+    $scope.pagination.cursors = [null];
+
+    /**
+     * Incremented on every new query so responses for an older query are dropped.
+     * @type {number}
+     */
+    $scope.pagination.generation = 0;
+
     /**
      * Returns the number of the pages in the pagination.
+     * With server paging, only the pages known to exist so far are counted.
      *
      * @returns {number}
      */
     $scope.pagination.numberOfPages = function () {
+        if ($scope.pagination.server) {
+            return $scope.pagination.cursors.length;
+        }
         return Math.ceil($scope.conferences.length / $scope.pagination.pageSize);
     };
 
+    /**
+     * Returns the index in $scope.conferences of the first conference of the current page.
+     *
+     * @returns {number}
+     */
+    $scope.pagination.offset = function () {
+        if ($scope.pagination.server) {
+            return 0;
+        }
+        return $scope.pagination.currentPage * $scope.pagination.pageSize;
+    };
+
+    /**
+     * Moves to the given page, fetching it from the server if needed.
+     *
+     * @param {number} page
+     */
+    $scope.pagination.goTo = function (page) {
+        if (page < 0 || page >= $scope.pagination.numberOfPages()) {
+            return;
+        }
+        $scope.pagination.currentPage = page;
+        if ($scope.pagination.server) {
+            $scope.showConferencePage(page);
+        }
+    };
+
     /**
      * Returns an array including the numbers from 1 to the number of the pages.
      *
@@ -424,7 +481,7 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
     };
 
     /**
-     * Invokes the conference.queryConferences API.
+     * Invokes the conference.queryConferences API for the first page and resets the page cache.
      */
     $scope.queryConferencesAll = function () {
         var sendFilters = {
@@ -440,38 +497,100 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
                 });
             }
         }
-        $scope.loading = true;
+        $scope.pagination.server = true;
+        $scope.pagination.filters = sendFilters.filters;
+        $scope.pagination.pages = [];
+        $scope.pagination.cursors = [null];
+        $scope.pagination.generation++;
+        $scope.pagination.currentPage = 0;
+        $scope.conferences = [];
+        $scope.showConferencePage(0);
+    }
+
+    /**
+     * Shows the given page of the query results, then prefetches the following one.
+     *
+     * @param {number} page
+     */
+    $scope.showConferencePage = function (page) {
+        if (!$scope.pagination.pages[page]) {
+            $scope.loading = true;
+        }
+        $scope.fetchConferencePage(page, function () {
+            if ($scope.pagination.currentPage != page) {
+                // the user moved on while this page was loading
+                return;
+            }
+            $scope.loading = false;
+            $scope.conferences = $scope.pagination.pages[page];
+            $scope.submitted = true;
+            if ($scope.pagination.cursors[page + 1]) {
+                $scope.fetchConferencePage(page + 1, angular.noop);
+            }
+        });
+    };
+
+    /**
+     * Invokes the conference.queryConferences API for one page, unless it is already cached.
+     *
+     * @param {number} page
+     * @param {Function} callback called within $apply once the page is cached
+     */
+    $scope.fetchConferencePage = function (page, callback) {
+        if ($scope.pagination.pages[page]) {
+            callback();
+            return;
+        }
+        var generation = $scope.pagination.generation;
+        var sendFilters = {
+            filters: $scope.pagination.filters,
+            pageSize: $scope.pagination.pageSize,
+            cursor: $scope.pagination.cursors[page]
+        };
         gapi.client.conference.queryConferences(sendFilters).
             execute(function (resp) {
                 $scope.$apply(function () {
-                    $scope.loading = false;
+                    if (generation != $scope.pagination.generation) {
+                        // a newer query has been submitted since
+                        return;
+                    }
                     if (resp.error) {
                         // The request has failed.
+                        $scope.loading = false;
                         var errorMessage = resp.error.message || '';
                         $scope.messages = 'Failed to query conferences : ' + errorMessage;
                         $scope.alertStatus = 'warning';
                         $log.error($scope.messages + ' filters : ' + JSON.stringify(sendFilters));
+                        $scope.submitted = true;
                     } else {
                         // The request has succeeded.
-                        $scope.submitted = false;
-                        $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters);
+                        $scope.messages = 'Query succeeded : ' + JSON.stringify(sendFilters.filters);
                         $scope.alertStatus = 'success';
                         $log.info($scope.messages);
 
-                        $scope.conferences = [];
-                        angular.forEach(resp.items, function (conference) {
-                            $scope.conferences.push(conference);
-                        });
+                        if (!(resp.items && resp.items.length) && resp.nextCursor) {
+                            // the server hit its scan limit before finding a match; carry on
+                            // from where it stopped instead of showing an empty page
+                            $scope.pagination.cursors[page] = resp.nextCursor;
+                            $scope.fetchConferencePage(page, callback);
+                            return;
+                        }
+                        $scope.pagination.pages[page] = resp.items || [];
+                        if (resp.nextCursor && $scope.pagination.cursors.length == page + 1) {
+                            $scope.pagination.cursors.push(resp.nextCursor);
+                        }
+                        callback();
                     }
-                    $scope.submitted = true;
                 });
             });
-    }
+    };
 
     /**
      * Invokes the conference.getConferencesCreated method.
      */
     $scope.getConferencesCreated = function () {
+        $scope.pagination.server = false;
+        $scope.pagination.currentPage = 0;
         $scope.loading = true;
         gapi.client.conference.getConferencesCreated().
             execute(function (resp) {
@@ -510,6 +629,8 @@ conferenceApp.controllers.controller('ShowConferenceCtrl', function ($scope, $lo
      * invokes the conference.getConference method n times where n == the number of the conferences to attend.
      */
     $scope.getConferencesAttend = function () {
+        $scope.pagination.server = false;
+        $scope.pagination.currentPage = 0;
         $scope.loading = true;
         gapi.client.conference.getConferencesToAttend().
             execute(function (resp) {
@@ -1,10 +1,124 @@
+import collections
+import hashlib
 import json
 import os
+import threading
 import time
 import uuid
 
+import endpoints
+from google.appengine.api import memcache
 from google.appengine.api import urlfetch
+from google.appengine.ext import ndb
 from models import Profile
+from models import TeeShirtSize
+
+# overridable so the oauth path can be pointed at a local fake server
+TOKENINFO_URL = os.getenv('TOKENINFO_URL',
+                          'https://www.googleapis.com/oauth2/v1/tokeninfo')
+TOKEN_CACHE_SIZE = 1000
+MEMCACHE_TOKEN_TPL = 'TOKEN_USER_ID_%s'
+# how long concurrent lookups of a token wait for the one in flight
+TOKENINFO_WAIT = 10
+
+
+class _TokenCache(object):
+    """Per-instance LRU of token hash -> (user_id, expiry timestamp)."""
+
+    def __init__(self, size):
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None or entry[1] <= time.time():
+                return None
+            # re-insert as most recently used
+            self._entries[key] = entry
+            return entry[0]
+
+    def set(self, key, user_id, expires_at):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (user_id, expires_at)
+            while len(self._entries) > self._size:
+                self._entries.popitem(last=False)
+
+
+_UNSET = object()
+_token_cache = _TokenCache(TOKEN_CACHE_SIZE)
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+
+def _fetchTokenInfo(token):
+    """Resolve token through the tokeninfo endpoint, retrying on errors."""
+    token_type = 'id_token'
+    if 'OAUTH_USER_ID' in os.environ:
+        token_type = 'access_token'
+    url = '%s?%s=%s' % (TOKENINFO_URL, token_type, token)
+    user = {}
+    wait = 1
+    for i in range(3):
+        resp = urlfetch.fetch(url)
+        if resp.status_code == 200:
+            user = json.loads(resp.content)
+            break
+        elif resp.status_code == 400 and 'invalid_token' in resp.content:
+            url = '%s?%s=%s' % (TOKENINFO_URL, 'access_token', token)
+        else:
+            time.sleep(wait)
+            wait = wait + i
+    return user
+
+
+def _getOAuthUserId(token):
+    """Return the user id of token: from the instance cache, memcache, or
+    a tokeninfo lookup shared by all concurrent callers of that token.
+    """
+    # never use the raw token as a cache key
+    key = hashlib.sha256(token).hexdigest()
+    user_id = _token_cache.get(key)
+    if user_id is not None:
+        return user_id
+
+    cached = memcache.get(MEMCACHE_TOKEN_TPL % key)
+    if cached and cached[1] > time.time():
+        _token_cache.set(key, *cached)
+        return cached[0]
+
+    with _inflight_lock:
+        event = _inflight.get(key)
+        leader = event is None
+        if leader:
+            event = _inflight[key] = threading.Event()
+
+    if not leader:
+        # another request is already resolving this token
+        event.wait(TOKENINFO_WAIT)
+        user_id = _token_cache.get(key)
+        if user_id is not None:
+            return user_id
+        return _fetchTokenInfo(token).get('user_id', '')
+
+    try:
+        user = _fetchTokenInfo(token)
+        user_id = user.get('user_id', '')
+        expires_in = int(user.get('expires_in', 0))
+        # cache only successful lookups, and no longer than the token lives
+        if user_id and expires_in > 0:
+            expires_at = time.time() + expires_in
+            _token_cache.set(key, user_id, expires_at)
+            memcache.set(MEMCACHE_TOKEN_TPL % key, (user_id, expires_at),
+                         time=expires_in)
+        return user_id
+    finally:
+        with _inflight_lock:
+            _inflight.pop(key, None)
+        event.set()
+
 
 def getUserId(user, id_type="email"):
     if id_type == "email":
@@ -14,25 +128,7 @@ def getUserId(user, id_type="email"):
         """A workaround implementation for getting userid."""
         auth = os.getenv('HTTP_AUTHORIZATION')
         bearer, token = auth.split()
-        token_type = 'id_token'
-        if 'OAUTH_USER_ID' in os.environ:
-            token_type = 'access_token'
-        url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-               % (token_type, token))
-        user = {}
-        wait = 1
-        for i in range(3):
-            resp = urlfetch.fetch(url)
-            if resp.status_code == 200:
-                user = json.loads(resp.content)
-                break
-            elif resp.status_code == 400 and 'invalid_token' in resp.content:
-                url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?%s=%s'
-                       % ('access_token', token))
-            else:
-                time.sleep(wait)
-                wait = wait + i
-        return user.get('user_id', '')
+        return _getOAuthUserId(token)
 
     if id_type == "custom":
         # implement your own user_id creation and getting algorythm
@@ -43,3 +139,65 @@ def getUserId(user, id_type="email"):
             return profile.id()
         else:
             return str(uuid.uuid1().get_hex())
+
+
+class RequestContext(object):
+    """Per-RPC cache of the signed in user, their user id and Profile.
+
+    Each of them is resolved lazily, at most once per request.
+    """
+
+    def __init__(self, request_id=None):
+        self.requestId = request_id
+        self._user = _UNSET
+        self._user_id = None
+        self._profile = None
+
+    @property
+    def user(self):
+        """The current endpoints user, or None."""
+        if self._user is _UNSET:
+            self._user = endpoints.get_current_user()
+        return self._user
+
+    def requireUser(self):
+        """Return the current user; raise if the request isn't authorized."""
+        if not self.user:
+            raise endpoints.UnauthorizedException('Authorization required')
+        return self.user
+
+    @property
+    def userId(self):
+        if self._user_id is None:
+            self._user_id = getUserId(self.requireUser())
+        return self._user_id
+
+    @property
+    def profileKey(self):
+        return ndb.Key(Profile, self.userId)
+
+    def getProfile(self):
+        """Return user Profile from datastore, creating new one if non-existent."""
+        if self._profile is None:
+            profile = self.profileKey.get()
+            # create new Profile if not there
+            if not profile:
+                user = self.requireUser()
+                profile = Profile(
+                    key=self.profileKey,
+                    displayName=user.nickname(),
+                    mainEmail=user.email(),
+                    teeShirtSize=str(TeeShirtSize.NOT_SPECIFIED),
+                )
+                profile.put()
+            self._profile = profile
+        return self._profile
+
+    def setProfile(self, profile):
+        """Replace the cached Profile, e.g. after a transaction wrote it."""
+        self._profile = profile
+
+    def putProfile(self, profile):
+        """Write profile through to the datastore and the cache."""
+        profile.put()
+        self._profile = profile